@@ -0,0 +1,225 @@
+from collections import OrderedDict, defaultdict
+import asyncio, sys, threading, time
+
+
+class _Entry:
+    __slots__ = ('value', 'expires', 'size', 'freq')
+
+    def __init__(self, value, expires, size):
+        self.value = value
+        self.expires = expires
+        self.size = size
+        self.freq = 1
+
+
+class _Flight:
+    '''a fetch in progress that other threads asking for the same key wait on'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class Cache:
+    '''
+    Caching dict of key to fetched value in the style of dicts.get, with eviction and single flight fetching.
+    Entries are evicted least recently used ('lru') or least frequently used ('lfu') first when there are
+    more than max_entries of them or their total size passes max_bytes, and expire after ttl seconds.
+    None results are cached too (negative caching), for negative_ttl seconds.  When several threads, or
+    tasks using afetch, miss on the same key at once only one of them calls the fetcher and the others wait
+    for its result.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, negative_ttl=None, policy='lru',
+                 size_fn=sys.getsizeof):
+        '''
+        :param max_entries: max number of entries, None for no limit
+        :param max_bytes: max total size of values as given by size_fn, None for no limit
+        :param ttl: seconds an entry stays valid, None for no expiry
+        :param negative_ttl: seconds a None result stays valid. Defaults to ttl.
+        :param policy: 'lru' or 'lfu'
+        :param size_fn: size of a value, only used if max_bytes is given
+        '''
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('unknown cache policy %s' % policy)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.policy = policy
+        self.size_fn = size_fn
+        self._entries = OrderedDict()
+        self._by_freq = defaultdict(OrderedDict)
+        self._min_freq = 0
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._flights = {}
+        self._async_flights = {}
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        '''
+        Peeks for an unexpired entry without counting a hit or miss or a use for eviction, so
+        "key in cache" followed by cache[key] counts once.
+        '''
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations,
+                    entries=len(self._entries), bytes=self._bytes)
+
+    def _unlink(self, key, entry):
+        del self._entries[key]
+        self._bytes -= entry.size
+        if self.policy == 'lfu':
+            bucket = self._by_freq[entry.freq]
+            del bucket[key]
+            if not bucket:
+                del self._by_freq[entry.freq]
+
+    def _touch(self, key, entry):
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+            return
+        bucket = self._by_freq[entry.freq]
+        del bucket[key]
+        if not bucket:
+            del self._by_freq[entry.freq]
+            if self._min_freq == entry.freq:
+                self._min_freq += 1
+        entry.freq += 1
+        self._by_freq[entry.freq][key] = None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires is not None and entry.expires <= time.monotonic():
+            self._unlink(key, entry)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _victim(self):
+        if self.policy == 'lru':
+            return next(iter(self._entries))
+        if self._min_freq not in self._by_freq:
+            self._min_freq = min(self._by_freq)
+        return next(iter(self._by_freq[self._min_freq]))
+
+    def _over_budget(self, extra_entries, extra_bytes):
+        return ((self.max_entries is not None and len(self._entries) + extra_entries > self.max_entries) or
+                (self.max_bytes is not None and self._bytes + extra_bytes > self.max_bytes))
+
+    def get(self, key, default=None):
+        '''
+        :return: the cached value for key or default if there is none
+        '''
+        found, value = self._cached(key)
+        return value if found else default
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._unlink(key, old)
+            ttl = self.negative_ttl if value is None else self.ttl
+            size = self.size_fn(value) if self.max_bytes is not None else 0
+            while self._entries and self._over_budget(1, size):
+                victim = self._victim()
+                self._unlink(victim, self._entries[victim])
+                self.evictions += 1
+            self._entries[key] = _Entry(value, None if ttl is None else time.monotonic() + ttl, size)
+            self._bytes += size
+            if self.policy == 'lfu':
+                self._by_freq[1][key] = None
+                self._min_freq = 1
+
+    __setitem__ = set
+
+    def __getitem__(self, key):
+        found, value = self._cached(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_freq.clear()
+            self._bytes = 0
+
+    def _cached(self, key):
+        '''(True, value) on a hit else (False, None)'''
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self._touch(key, entry)
+            return True, entry.value
+
+    def fetch(self, key, fetcher):
+        '''
+        Returns the cached value of key, calling fetcher(key) to get and cache it on a miss. Only one
+        thread calls fetcher for a key at a time; others missing on it meanwhile get its result or exception.
+        '''
+        found, value = self._cached(key)
+        if found:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                entry = self._lookup(key)  # a leader may have cached it since the miss above
+                if entry is not None:
+                    return entry.value
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.value
+        try:
+            flight.value = fetcher(key)
+            self.set(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def afetch(self, key, fetcher):
+        '''
+        Async version of fetch for an async fetcher. Concurrent tasks missing on the same key share one
+        call of fetcher.
+        '''
+        found, value = self._cached(key)
+        if found:
+            return value
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        flight = self._async_flights[key] = asyncio.ensure_future(fetcher(key))
+        try:
+            value = await asyncio.shield(flight)
+            self.set(key, value)
+            return value
+        finally:
+            if self._async_flights.get(key) is flight:
+                del self._async_flights[key]
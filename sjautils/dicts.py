@@ -1,4 +1,10 @@
+from bisect import bisect_left
+import copy
 import inspect
+import re
+from functools import lru_cache
+from collections.abc import Mapping
+from sjautils.cache import Cache
 
 def first_kv(a_dict):
     return list(a_dict.items())[0]
@@ -6,43 +12,353 @@ def first_kv(a_dict):
 def get(a_dict, key, fetcher):
     """
     More or less caching dict with fetche function to fetch
-    and cache value of key if not present.  Returns value of key
-    """   
-    known = a_dict.get(key)
-    if not known:
-        known = a_dict[key] = fetcher(key)
+    and cache value of key if not present.  Returns value of key.
+    a_dict may also be a sjautils.cache.Cache for eviction and single flight fetching.
+    """
+    if isinstance(a_dict, Cache):
+        return a_dict.fetch(key, fetcher)
+    if key in a_dict:
+        return a_dict[key]
+    known = a_dict[key] = fetcher(key)
     return known
 
-def flat_keys(arg, key=''):
-    acc = {}
-
-    def flatten(something, key):
-        key_extend = lambda ek: ('%s[%s]' % (key, ek)) if key else ek
-        if isinstance(something, dict):
-            for k, v in something.items():
-                nk = key_extend(k)
-                flatten(v, nk)
-        elif isinstance(something, list or isinstance(something, tuple)):
-            for index, item in enumerate(something):
-                flatten(item, key_extend(index))
+def leaf_paths(something):
+    '''
+    Generator of (path, leaf) pairs for the scalar leaves of nested dicts, lists and tuples. Paths are
+    tuples of the keys and indices leading to the leaf.  Uses an explicit stack so deep structures
+    do not hit the recursion limit.  Empty containers have no leaves.
+    '''
+    if isinstance(something, dict):
+        stack = [iter(something.items())]
+    elif isinstance(something, (list, tuple)):
+        stack = [enumerate(something)]
+    else:
+        yield (), something
+        return
+    path = []
+    while stack:
+        for k, v in stack[-1]:
+            if isinstance(v, dict):
+                path.append(k)
+                stack.append(iter(v.items()))
+                break
+            elif isinstance(v, (list, tuple)):
+                path.append(k)
+                stack.append(enumerate(v))
+                break
+            else:
+                yield tuple(path) + (k,), v
         else:
-            acc[key] = something
+            stack.pop()
+            if path:
+                path.pop()
+
+
+def render_path(path, key=''):
+    '''
+    renders a leaf_paths path as a flat_keys string key, e.g. ('a', 0, 'b') as 'a[0][b]'
+    '''
+    for k in path:
+        key = ('%s[%s]' % (key, k)) if key != '' else k
+    return key
+
+
+def flat_keys(arg, key='', as_tuples=False):
+    '''
+    Flattens nested dicts, lists and tuples into a dict of leaf values.
+    :param arg: the structure to flatten
+    :param key: prefix for the string keys
+    :param as_tuples: if True keys are the leaf_paths tuples rather than strings
+    :return: dict of key to leaf value
+    '''
+    if as_tuples:
+        return dict(leaf_paths(arg))
+    return {render_path(path, key): leaf for path, leaf in leaf_paths(arg)}
+
+
+class SubtreeHashes:
+    '''
+    Merkle style hashes of nested dicts, lists and tuples, computed bottom up without recursion and cached
+    by object id so every container is hashed once per run.  Equal structures hash equal; unequal ones
+    almost always differ, so equal hashes still need confirming with == but differing hashes prove the
+    subtrees differ.  An instance should only be used while the hashed objects are unchanged.
+    '''
 
-    flatten(arg, key)
-    return acc
+    def __init__(self):
+        self._cache = {}
+
+    @staticmethod
+    def _is_container(obj):
+        return isinstance(obj, (dict, list, tuple))
+
+    def _scalar_hash(self, obj):
+        try:
+            return hash(obj)
+        except TypeError:
+            return 0
+
+    def _known(self, obj):
+        cached = self._cache.get(id(obj))
+        return cached is not None and cached[0] is obj
+
+    def _child_hash(self, obj):
+        return self._cache[id(obj)][1] if self._is_container(obj) else self._scalar_hash(obj)
+
+    def __call__(self, root):
+        if not self._is_container(root):
+            return self._scalar_hash(root)
+        stack = [root]
+        while stack:
+            obj = stack[-1]
+            if self._known(obj):
+                stack.pop()
+                continue
+            children = obj.values() if isinstance(obj, dict) else obj
+            pending = [c for c in children if self._is_container(c) and not self._known(c)]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if isinstance(obj, dict):
+                value = hash(('d', frozenset((k, self._child_hash(v)) for k, v in obj.items())))
+            else:
+                value = hash(('l', tuple(self._child_hash(v) for v in obj)))
+            self._cache[id(obj)] = (obj, value)
+        return self._cache[id(root)][1]
+
+    def same(self, a, b):
+        return a is b or (self(a) == self(b) and a == b)
+
+
+def _is_sequence(obj):
+    return isinstance(obj, (list, tuple))
 
 
 def diff(new, old):
-    flat_new = flat_keys(new)
-    flat_old = flat_keys(old)
-    modified = {k: v for k, v in flat_new.items() if k in flat_old and flat_old[k] != v}
-    added = {k: v for k, v in flat_new.items() if k not in flat_old}
-    dropped = {k: v for k, v in flat_old.items() if k not in flat_new}
+    '''
+    Differences between two documents as dicts of flat_keys style keys to values: modified, added and dropped.
+    Subtrees that are equal in both are skipped using SubtreeHashes rather than flattened and compared.
+    '''
+    modified, added, dropped = {}, {}, {}
+    hashes = SubtreeHashes()
+
+    def flat_at(path, sub):
+        return {render_path(path + p): leaf for p, leaf in leaf_paths(sub)}
+
+    stack = [((), new, old)]
+    while stack:
+        path, n, o = stack.pop()
+        if hashes.same(n, o):
+            continue
+        if isinstance(n, dict) and isinstance(o, dict):
+            for k, v in n.items():
+                if k in o:
+                    stack.append((path + (k,), v, o[k]))
+                else:
+                    added.update(flat_at(path + (k,), v))
+            for k, v in o.items():
+                if k not in n:
+                    dropped.update(flat_at(path + (k,), v))
+        elif _is_sequence(n) and _is_sequence(o):
+            common = min(len(n), len(o))
+            for i in range(common):
+                stack.append((path + (i,), n[i], o[i]))
+            for i in range(common, len(n)):
+                added.update(flat_at(path + (i,), n[i]))
+            for i in range(common, len(o)):
+                dropped.update(flat_at(path + (i,), o[i]))
+        else:
+            flat_new, flat_old = flat_at(path, n), flat_at(path, o)
+            modified.update({k: v for k, v in flat_new.items() if k in flat_old and flat_old[k] != v})
+            added.update({k: v for k, v in flat_new.items() if k not in flat_old})
+            dropped.update({k: v for k, v in flat_old.items() if k not in flat_new})
     return dict(
         modified=modified, added=added, dropped=dropped
     )
 
 
+def _longest_increasing(seq):
+    '''
+    set of the values of a longest strictly increasing subsequence of seq
+    '''
+    tails, tail_at, previous = [], [], [None] * len(seq)
+    for i, v in enumerate(seq):
+        pos = bisect_left(tails, v)
+        previous[i] = tail_at[pos - 1] if pos else None
+        if pos == len(tails):
+            tails.append(v)
+            tail_at.append(i)
+        else:
+            tails[pos] = v
+            tail_at[pos] = i
+    res = set()
+    i = tail_at[-1] if tail_at else None
+    while i is not None:
+        res.add(seq[i])
+        i = previous[i]
+    return res
+
+
+def _list_moves(path, new, old, hashes):
+    '''
+    ops turning list old into list new. Unmatched old elements are removed, then in target order matched
+    elements outside a longest run already in order are moved and unmatched new elements are added, so
+    the number of moves is minimal.
+    '''
+    by_hash = {}
+    for i, v in enumerate(old):
+        by_hash.setdefault(hashes(v), []).append(i)
+    matches = []
+    used = set()
+    for v in new:
+        match = None
+        for i in by_hash.get(hashes(v), ()):
+            if i not in used and old[i] == v:
+                match = i
+                used.add(i)
+                break
+        matches.append(match)
+    ops = [dict(op='remove', path=path + (i,), value=old[i]) for i in reversed(range(len(old))) if i not in used]
+    stable = _longest_increasing([m for m in matches if m is not None])
+    # working holds old indices of the current list, those still to be moved being ghosts that do not
+    # count towards target positions.  Added elements are represented by None.
+    working = [i for i in range(len(old)) if i in used]
+    ghosts = used - stable
+
+    def position(target):
+        placed = 0
+        for p, i in enumerate(working):
+            if placed == target:
+                return p
+            if i not in ghosts:
+                placed += 1
+        return len(working)
+
+    for target, (match, v) in enumerate(zip(matches, new)):
+        if match in stable:
+            continue
+        if match is None:
+            p = position(target)
+            ops.append(dict(op='add', path=path + (p,), value=v))
+            working.insert(p, None)
+            continue
+        current = working.index(match)
+        del working[current]
+        ghosts.discard(match)
+        p = position(target)
+        working.insert(p, match)
+        if p != current:
+            ops.append(dict(op='move', path=path + (p,), **{'from': path + (current,)}))
+    return ops
+
+
+def structural_diff(new, old, detect_moves=False):
+    '''
+    Patch turning old into new as a list of JSON-Patch like operations, skipping equal subtrees using
+    SubtreeHashes.  Each operation is a dict with 'op' (add, remove, replace or move) and 'path', a tuple of
+    keys and indices.  add and remove carry the 'value' added or removed, replace carries the new 'value'
+    and the 'old' one and move carries the 'from' path, so patches can be inverted.
+    :param new: new version of the document
+    :param old: old version of the document
+    :param detect_moves: if True list elements that only moved are reported as moves rather than
+      as every shifted index being modified
+    :return: list of operations to apply in order
+    '''
+    hashes = SubtreeHashes()
+    ops = []
+    stack = [((), new, old)]
+    while stack:
+        path, n, o = stack.pop()
+        if hashes.same(n, o):
+            continue
+        if isinstance(n, dict) and isinstance(o, dict):
+            for k, v in o.items():
+                if k not in n:
+                    ops.append(dict(op='remove', path=path + (k,), value=v))
+            for k, v in n.items():
+                if k in o:
+                    stack.append((path + (k,), v, o[k]))
+                else:
+                    ops.append(dict(op='add', path=path + (k,), value=v))
+        elif isinstance(n, list) and isinstance(o, list) and detect_moves:
+            ops.extend(_list_moves(path, n, o, hashes))
+        elif isinstance(n, list) and isinstance(o, list):
+            common = min(len(n), len(o))
+            ops.extend(dict(op='remove', path=path + (i,), value=o[i]) for i in reversed(range(common, len(o))))
+            ops.extend(dict(op='add', path=path + (i,), value=n[i]) for i in range(common, len(n)))
+            for i in reversed(range(common)):
+                stack.append((path + (i,), n[i], o[i]))
+        else:
+            ops.append(dict(op='replace', path=path, value=n, old=o))
+    return ops
+
+
+def _parent(doc, path):
+    for k in path[:-1]:
+        doc = doc[k]
+    return doc
+
+
+def apply_patch(doc, patch, in_place=False):
+    '''
+    Applies a structural_diff patch to doc.
+    :param doc: the document, dicts and lists within it being changed
+    :param patch: list of operations
+    :param in_place: if False doc is deep copied first
+    :return: the patched document
+    '''
+    if not in_place:
+        doc = copy.deepcopy(doc)
+    for op in patch:
+        kind, path = op['op'], op['path']
+        if not path:
+            if kind != 'replace':
+                raise ValueError('only replace can apply to the whole document')
+            doc = copy.deepcopy(op['value'])
+            continue
+        parent, key = _parent(doc, path), path[-1]
+        if kind == 'replace':
+            parent[key] = copy.deepcopy(op['value'])
+        elif kind == 'add':
+            if isinstance(parent, list):
+                parent.insert(key, copy.deepcopy(op['value']))
+            else:
+                parent[key] = copy.deepcopy(op['value'])
+        elif kind == 'remove':
+            del parent[key]
+        elif kind == 'move':
+            source = op['from']
+            value = _parent(doc, source)[source[-1]]
+            del _parent(doc, source)[source[-1]]
+            if isinstance(parent, list):
+                parent.insert(key, value)
+            else:
+                parent[key] = value
+        else:
+            raise ValueError('unknown patch operation %s' % kind)
+    return doc
+
+
+def invert_patch(patch):
+    '''
+    :return: the patch undoing patch
+    '''
+    inverse = []
+    for op in reversed(patch):
+        kind = op['op']
+        if kind == 'add':
+            inverse.append(dict(op='remove', path=op['path'], value=op['value']))
+        elif kind == 'remove':
+            inverse.append(dict(op='add', path=op['path'], value=op['value']))
+        elif kind == 'replace':
+            inverse.append(dict(op='replace', path=op['path'], value=op['old'], old=op['value']))
+        elif kind == 'move':
+            inverse.append(dict(op='move', path=op['from'], **{'from': op['path']}))
+        else:
+            raise ValueError('unknown patch operation %s' % kind)
+    return inverse
+
+
 def ensure_in_dict(a_dict, key, value):
     if key not in a_dict:
         a_dict[key] = value
@@ -73,17 +389,106 @@ def without_keys(a_dict, *keys):
     return {k: v for k, v in a_dict.items() if k not in keys}
 
 
-def values(a_dict, *kp):
-    def get(d, key):
-        if '.' in key:
-            parts = key.split('.')
-            sub = a_dict.get(parts[0], {})
-            rest = '.'.join(parts[1:])
-            return get(sub, rest)
+_WILDCARD = '*'
+_path_part = re.compile(r'([^.\[\]]+)|\[(\*|-?\d+)\]')
+_lookup_errors = (KeyError, IndexError, TypeError)
+
+
+def parse_path(path):
+    '''
+    Parses a path such as 'a.b', 'c.d[0]' or 'items[*].id' into a tuple of steps: keys, list indices and
+    '*' for fanning out over all elements of a list or values of a dict.  A tuple or list path is taken
+    as already parsed.
+    '''
+    if not isinstance(path, str):
+        return tuple(path)
+    steps = []
+    for key, index in _path_part.findall(path):
+        if key:
+            steps.append(key)
         else:
-            return d.get(key)
+            steps.append(index if index == _WILDCARD else int(index))
+    return tuple(steps)
 
-    return [get(a_dict, k) for k in kp]
+
+def _compile_path(steps, default):
+    '''
+    generates a function for one parsed path. Steps up to the first wildcard become a single subscript
+    expression; the rest of the path is compiled separately and mapped over the fanned out elements.
+    '''
+    if _WILDCARD in steps:
+        split = steps.index(_WILDCARD)
+        head, rest = steps[:split], steps[split + 1:]
+    else:
+        head, rest = steps, None
+    expr = 'obj' + ''.join('[%r]' % k for k in head)
+    names = dict(default=default, lookup_errors=_lookup_errors)
+    if rest is None:
+        source = 'def get(obj):\n try:\n  return %s\n except lookup_errors:\n  return default\n' % expr
+    else:
+        names['each'] = _compile_path(rest, default)
+        source = ('def get(obj):\n try:\n  found = %s\n except lookup_errors:\n  return default\n'
+                  ' if isinstance(found, dict):\n  found = found.values()\n'
+                  ' try:\n  return [each(x) for x in found]\n except TypeError:\n  return default\n' % expr)
+    exec(source, names)
+    return names['get']
+
+
+class PathExtractor:
+    '''
+    Extracts the values at several paths from records, the paths being parsed and compiled once.
+    Calling it on a record returns a tuple of the values in path order.
+    '''
+
+    def __init__(self, paths, default=None, defaults=None):
+        defaults = defaults or {}
+        self.paths = tuple(paths)
+        self._getters = [_compile_path(parse_path(p), defaults.get(p, default)) for p in self.paths]
+        if len(self._getters) == 1:
+            only = self._getters[0]
+            self._extract = lambda record: (only(record),)
+        else:
+            getters = self._getters
+            self._extract = lambda record: tuple([g(record) for g in getters])
+
+    def __call__(self, record):
+        return self._extract(record)
+
+    def columns(self, records, as_arrays=False):
+        '''
+        Extracts every path from every record.
+        :param records: iterable of records
+        :param as_arrays: if True each column is made a NumPy array (requires numpy)
+        :return: dict of path to list (or array) of its values in record order
+        '''
+        records = records if isinstance(records, list) else list(records)
+        cols = {p: list(map(g, records)) for p, g in zip(self.paths, self._getters)}
+        if as_arrays:
+            import numpy as np
+            cols = {p: np.asarray(c) for p, c in cols.items()}
+        return cols
+
+
+def compile_paths(*paths, default=None, defaults=None):
+    '''
+    :param paths: paths such as 'a.b', 'c.d[0]' or 'items[*].id', see parse_path
+    :param default: value for a path missing in a record
+    :param defaults: optional dict of path to its own default
+    :return: PathExtractor for the paths
+    '''
+    return PathExtractor(paths, default, defaults)
+
+
+@lru_cache(maxsize=256)
+def _cached_extractor(paths):
+    return PathExtractor(paths)
+
+
+def values(a_dict, *kp):
+    '''
+    :return: list of the values at dotted key paths kp of a_dict, None for missing ones
+    '''
+    return list(_cached_extractor(kp)(a_dict))
 
 
 def add_missing(a_dict, missing_dict):
@@ -97,9 +502,12 @@ class DictObject(dict):
     multiple level dictionaries as well.
     '''
 
+    _lazy = False
+
     def __init__(self, **data):
         super().__init__(**data)
-        self._adjust_dicts()
+        if not self._lazy:
+            self._adjust_dicts()
 
     def _adjust_dicts(self):
         for k, v in self.items():
@@ -114,6 +522,110 @@ class DictObject(dict):
             val = DictObject(**val)
         self[name] = val
 
+
+class LazyDictObject(DictObject):
+    '''
+    DictObject that only wraps a nested dict when it is first accessed, by attribute or key, and then keeps
+    the wrapper in place of the dict. Wrapping a large document costs a shallow copy of its top level
+    rather than a rebuild of every level.  Values seen through items() or values() before being
+    accessed are still plain dicts.
+    '''
+
+    _lazy = True
+
+    def _wrapped(self, name, val):
+        if type(val) is dict:
+            val = LazyDictObject(**val)
+            dict.__setitem__(self, name, val)
+        return val
+
+    def __getitem__(self, name):
+        return self._wrapped(name, dict.__getitem__(self, name))
+
+    def get(self, name, default=None):
+        return self._wrapped(name, dict.get(self, name, default)) if name in self else default
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+    def __setattr__(self, name, val):
+        self[name] = val
+
+
+class DictView(Mapping):
+    '''
+    Read-only, zero copy view of a dict with the attribute access of DictObject. Nested dicts are seen
+    through their own DictView, created on first access and cached.  Changes to the underlying dict show
+    through the view.
+    '''
+
+    __slots__ = ('_data', '_views')
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_views', {})
+
+    def _view(self, name, val):
+        if isinstance(val, dict):
+            view = self._views.get(name)
+            if view is None or view._data is not val:
+                view = self._views[name] = DictView(val)
+            return view
+        return val
+
+    def __getitem__(self, name):
+        return self._view(name, self._data[name])
+
+    def __getattr__(self, name):
+        return self._view(name, self._data.get(name))
+
+    def __setattr__(self, name, val):
+        raise AttributeError('DictView is read-only')
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'DictView(%r)' % (self._data,)
+
+
+def frozen_record(name, *fields):
+    '''
+    Creates a compact immutable record class for dicts with known keys, using __slots__ rather than a
+    per instance dict.  Missing keys are None.
+    :param name: class name
+    :param fields: the known keys
+    :return: the record class. Build instances from a dict with its from_dict classmethod.
+    '''
+
+    def __init__(self, **data):
+        for f in fields:
+            object.__setattr__(self, f, data.get(f))
+
+    def __setattr__(self, f, val):
+        raise AttributeError('%s is frozen' % name)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(getattr(self, f) == getattr(other, f) for f in fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (name, ', '.join('%s=%r' % (f, getattr(self, f)) for f in fields))
+
+    return type(name, (), dict(
+        __slots__=tuple(fields),
+        __init__=__init__,
+        __setattr__=__setattr__,
+        __eq__=__eq__,
+        __hash__=lambda self: hash(tuple(getattr(self, f) for f in fields)),
+        __repr__=__repr__,
+        from_dict=classmethod(lambda cls, d: cls(**{f: d.get(f) for f in fields})),
+        as_dict=lambda self: {f: getattr(self, f) for f in fields},
+        fields=tuple(fields)))
+
+
 def keys(a_dict):
   return list(a_dict.keys())
 
@@ -133,6 +645,10 @@ class ImmutableKeysDict(DictObject):
             dict.__setitem__(self, key, value)
 
 
+class LazyImmutableKeysDict(ImmutableKeysDict, LazyDictObject):
+    '''ImmutableKeysDict wrapping nested dicts lazily as LazyDictObject does'''
+
+
 def param_dict(smash_kwargs=True):
     '''
     To be called within a function. Returns a dictionary of values the function was called with.
@@ -0,0 +1,310 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from functools import reduce
+from types import MappingProxyType
+import random
+
+_no_ids = frozenset()
+
+
+class IndexedCollection:
+    '''
+    Collection of dict records answering equality_filter style queries through hash indexes and range
+    queries through sorted indexes.  An index on a field is only built the first time a query uses that
+    field and is kept up to date by insert and remove from then on.  As with equality_filter a missing
+    field is treated as having the value None.
+    '''
+
+    def __init__(self, items=()):
+        self._records = {}
+        self._next_id = 0
+        self._hash_indexes = {}
+        self._unhashable = {}
+        self._sorted_indexes = {}
+        for item in items:
+            self.insert(item)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __contains__(self, record_id):
+        return record_id in self._records
+
+    def get(self, record_id):
+        return self._records.get(record_id)
+
+    def insert(self, item):
+        '''
+        Adds item to the collection and to all indexes built so far.
+        :return: the id of the record within this collection
+        '''
+        record_id = self._next_id
+        self._next_id += 1
+        self._records[record_id] = item
+        for field in self._hash_indexes:
+            self._hash_add(field, record_id, item)
+        for field, index in self._sorted_indexes.items():
+            value = item.get(field)
+            if value is not None:
+                insort(index, (value, record_id))
+        return record_id
+
+    def remove(self, record_id):
+        '''
+        Removes the record with the given id from the collection and its indexes.
+        :return: the removed record
+        '''
+        item = self._records.pop(record_id)
+        for field, index in self._hash_indexes.items():
+            value = item.get(field)
+            try:
+                ids = index.get(value)
+            except TypeError:
+                self._unhashable[field].discard(record_id)
+                continue
+            ids.discard(record_id)
+            if not ids:
+                del index[value]
+        for field, index in self._sorted_indexes.items():
+            value = item.get(field)
+            if value is not None:
+                del index[bisect_left(index, (value, record_id))]
+        return item
+
+    def _hash_add(self, field, record_id, item):
+        value = item.get(field)
+        try:
+            self._hash_indexes[field][value].add(record_id)
+        except TypeError:
+            self._unhashable[field].add(record_id)
+
+    def _hash_index(self, field):
+        if field not in self._hash_indexes:
+            self._hash_indexes[field] = defaultdict(set)
+            self._unhashable[field] = set()
+            for record_id, item in self._records.items():
+                self._hash_add(field, record_id, item)
+        return self._hash_indexes[field]
+
+    def _sorted_index(self, field):
+        if field not in self._sorted_indexes:
+            self._sorted_indexes[field] = sorted(
+                (item.get(field), record_id) for record_id, item in self._records.items()
+                if item.get(field) is not None)
+        return self._sorted_indexes[field]
+
+    def _equal_ids(self, field, value):
+        '''ids of records whose field equals value, possibly the index's own set so not to be modified'''
+        index = self._hash_index(field)
+        try:
+            ids = index.get(value, _no_ids)
+        except TypeError:
+            ids = _no_ids
+        unhashable = self._unhashable[field]
+        if unhashable:
+            extra = {i for i in unhashable if self._records[i].get(field) == value}
+            if extra:
+                ids = ids | extra
+        return ids
+
+    def ids_equal(self, field, value):
+        '''
+        :return: set of ids of records whose field equals value
+        '''
+        return set(self._equal_ids(field, value))
+
+    def ids_in_range(self, field, low=None, high=None, include_high=False):
+        '''
+        :return: set of ids of records with low <= field < high (or <= high if include_high). Either bound
+          may be None for an open range. Records without the field are never included.
+        '''
+        index = self._sorted_index(field)
+        start = 0 if low is None else bisect_left(index, (low,))
+        if high is None:
+            end = len(index)
+        elif include_high:
+            end = bisect_right(index, (high, float('inf')))
+        else:
+            end = bisect_left(index, (high,))
+        return {record_id for _, record_id in index[start:end]}
+
+    def ids_matching(self, **field_values):
+        '''
+        :return: set of ids of records having all the given field values. Only the smallest index bucket
+          is copied; it is intersected with the others in order of size, stopping as soon as it is empty.
+        '''
+        if not field_values:
+            return set(self._records)
+        candidates = sorted((self._equal_ids(k, v) for k, v in field_values.items()), key=len)
+        result = set(candidates[0])
+        for ids in candidates[1:]:
+            if not result:
+                break
+            result &= ids
+        return result
+
+    def _records_for(self, ids):
+        return [self._records[i] for i in sorted(ids)]
+
+    def equality_filter(self, **field_values):
+        '''
+        Indexed equivalent of utils.equality_filter
+        :return: list of records, in insertion order, having all the given field values
+        '''
+        return self._records_for(self.ids_matching(**field_values))
+
+    def any_of(self, *field_value_dicts):
+        '''
+        :param field_value_dicts: dicts of field values, each of which is ANDed as for equality_filter
+        :return: list of records, in insertion order, matching at least one of the dicts
+        '''
+        return self._records_for(reduce(lambda a, fv: a | self.ids_matching(**fv), field_value_dicts, set()))
+
+    def in_range(self, field, low=None, high=None, include_high=False, **field_values):
+        '''
+        :return: list of records, in insertion order, in the range for field and having any other field_values
+        '''
+        ids = self.ids_in_range(field, low, high, include_high)
+        if field_values and ids:
+            ids &= self.ids_matching(**field_values)
+        return self._records_for(ids)
+
+
+class MultiIndexStore:
+    '''
+    Store of dict items indexed by any number of unique and non-unique keys. The first unique key is the
+    primary key identifying items for update and removal.  Items are kept in a dense list with swap-remove
+    so random_instance is O(1), and the maps returned are read-only views rather than copies.
+    '''
+
+    __slots__ = ('_primary', '_unique', '_multi', '_items', '_positions', '_enforce_unique')
+
+    def __init__(self, primary, *unique, multi=(), enforce_unique=True):
+        '''
+        :param primary: name of the primary key field
+        :param unique: names of other fields whose values must be unique among items having them
+        :param multi: names of fields whose values may be shared
+        :param enforce_unique: if False a unique field value already used by another item is simply taken
+          over by the item added last instead of raising ValueError
+        '''
+        self._enforce_unique = enforce_unique
+        self._primary = primary
+        self._unique = {k: {} for k in (primary,) + unique}
+        self._multi = {k: {} for k in multi}
+        self._items = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def _check_unique(self, item, key):
+        for field, index in self._unique.items():
+            other = index.get(item.get(field))
+            if (other is not None) and (other[self._primary] != key):
+                raise ValueError('%s %s already used by %s' % (field, item.get(field), other[self._primary]))
+
+    def _index(self, item, key):
+        for field, index in self._unique.items():
+            if field in item:
+                index[item[field]] = item
+        for field, index in self._multi.items():
+            if field in item:
+                index.setdefault(item[field], {})[key] = item
+
+    def _unindex(self, item, key):
+        for field, index in self._unique.items():
+            if (field in item) and (index.get(item[field]) is item):  # unless taken over by another item
+                del index[item[field]]
+        for field, index in self._multi.items():
+            if field in item:
+                shared = index[item[field]]
+                del shared[key]
+                if not shared:
+                    del index[item[field]]
+
+    def add(self, item):
+        '''
+        Adds item, replacing any item with the same primary key.
+        Raises ValueError if a unique key value is already used by another item and enforce_unique is set.
+        '''
+        key = item[self._primary]
+        if self._enforce_unique:
+            self._check_unique(item, key)
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self._items)
+            self._items.append(item)
+        else:
+            self._unindex(self._items[position], key)
+            self._items[position] = item
+        self._index(item, key)
+
+    def remove(self, key):
+        '''
+        Removes and returns the item with the given primary key, None if there is none.
+        '''
+        position = self._positions.pop(key, None)
+        if position is None:
+            return None
+        item = self._items[position]
+        last = self._items.pop()
+        if last is not item:
+            self._items[position] = last
+            self._positions[last[self._primary]] = position
+        self._unindex(item, key)
+        return item
+
+    def update(self, key, **changes):
+        '''
+        Updates fields of the item with the given primary key in place, maintaining the indexes.
+        Changing the primary key itself is not supported; remove and add instead.
+        :return: the updated item
+        '''
+        if self._primary in changes:
+            raise ValueError('cannot update primary key %s' % self._primary)
+        item = self._items[self._positions[key]]
+        if self._enforce_unique:
+            self._check_unique(changes, key)
+        self._unindex(item, key)
+        item.update(changes)
+        self._index(item, key)
+        return item
+
+    def get(self, field, value):
+        '''
+        :return: the item with unique field equal to value or None
+        '''
+        return self._unique[field].get(value)
+
+    def get_all(self, field, value):
+        '''
+        :return: read-only view of primary key to item for items whose non-unique field equals value
+        '''
+        return MappingProxyType(self._multi[field].get(value, {}))
+
+    def unique_map(self, field):
+        '''
+        :return: read-only view of value to item for a unique field
+        '''
+        return MappingProxyType(self._unique[field])
+
+    def multi_map(self, field):
+        '''
+        :return: read-only view of value to {primary key: item} for a non-unique field
+        '''
+        return MappingProxyType(self._multi[field])
+
+    def values(self):
+        return self._unique[self._primary].values()
+
+    def random_instance(self):
+        return random.choice(self._items) if self._items else None
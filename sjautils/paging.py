@@ -1,12 +1,54 @@
 from collections import deque
-from sjautils.utils import get_logger
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import asyncio, queue, threading
+from sjautils.utils import get_logger, prefetched, aprefetched, fused_filter
+from sjautils.retry import RetryPolicy
 from functools import wraps
 import time
 
 logger = get_logger()
 
 
-def do_all(operation, paging_key, result_key, argument_key=None, **kwargs):
+def _advance(args, response, paging_key, argument_key, old_more):
+    '''
+    Updates args for the next page of a paging operation.
+    :return: the paging value for the next page, None if there is none.
+    Raises if the paging key does not advance.
+    '''
+    more_data = response.get(paging_key)
+    if more_data and (old_more == more_data):
+        raise Exception('paging not working!')
+    if more_data:
+        args[argument_key or paging_key] = more_data
+    return more_data
+
+
+def _pages(operation, paging_key, argument_key, kwargs):
+    '''
+    Generator of the successive raw responses of a paging operation.
+    '''
+    args = dict(kwargs)
+    more_data = None
+    while True:
+        response = operation(**args)
+        yield response
+        more_data = _advance(args, response, paging_key, argument_key, more_data)
+        if not more_data:
+            break
+
+
+async def _apages(operation, paging_key, argument_key, kwargs):
+    args = dict(kwargs)
+    more_data = None
+    while True:
+        response = await operation(**args)
+        yield response
+        more_data = _advance(args, response, paging_key, argument_key, more_data)
+        if not more_data:
+            break
+
+
+def do_all(operation, paging_key, result_key, argument_key=None, lookahead=0, **kwargs):
     '''
     Performs some AWS or other paging operation returning successive results
     :param operation: operation function to call
@@ -14,50 +56,172 @@ def do_all(operation, paging_key, result_key, argument_key=None, **kwargs):
     :param paging_key: key of operation result signifying more data
     :param result_key: part of operation response to return as result to caller.
     :param argument_key: optional key to pass to operation for paging if different from paging_key
+    :param lookahead: if non-zero following pages are requested on a background thread as soon as
+      the paging key is known, keeping at most this many pages ahead of the caller.
     :return: generator of items returned
     '''
-    if not argument_key:
-        argument_key = paging_key
-    done = False
-    args = dict(kwargs)
-    more_data = None
-    while not done:
-        response = operation(**args)
+    pages = _pages(operation, paging_key, argument_key, kwargs)
+    if lookahead:
+        pages = prefetched(pages, lookahead)
+    for response in pages:
+        yield from response.get(result_key, [])
+
+
+_segment_done = object()
+
+
+async def ado_all(operation, paging_key, result_key, argument_key=None, lookahead=0, **kwargs):
+    '''
+    Async version of do_all for an async operation.
+    :param lookahead: if non-zero following pages are requested by a separate task as soon as the
+      paging key is known, keeping at most this many pages ahead of the caller.
+    :return: async generator of items returned
+    '''
+    pages = _apages(operation, paging_key, argument_key, kwargs)
+    if lookahead:
+        pages = aprefetched(pages, lookahead)
+    async for response in pages:
         for item in response.get(result_key, []):
             yield item
-        old_more = more_data
-        more_data = response.get(paging_key)
-        if more_data and (old_more == more_data):
-            raise Exception('paging not working!')
-        if more_data:
-            args[argument_key] = more_data
+
+
+def do_all_parallel(operation, paging_key, result_key, argument_key=None, segments=4, ordered=False,
+                    segment_key='Segment', total_segments_key='TotalSegments', retry_sleep=1.0,
+                    buffer_size=1000, **kwargs):
+    '''
+    Runs a do_all per segment concurrently for paging operations that support parallel segments,
+    e.g. DynamoDB Scan with Segment/TotalSegments. Each segment is retried on its own when throttled
+    with TooManyRequestsException.
+    :param operation: operation function to call
+    :param paging_key: see do_all
+    :param result_key: see do_all
+    :param argument_key: see do_all
+    :param segments: number of segments, each run on its own thread
+    :param ordered: if True yield all items of segment 0, then segment 1 and so on, buffering items of
+      later segments that arrive early up to buffer_size per segment.  A failure of a later segment is
+      raised when that segment is reached.  Otherwise items are yielded interleaved as they arrive.
+    :param segment_key: argument naming the segment number for operation
+    :param total_segments_key: argument naming the number of segments for operation
+    :param retry_sleep: seconds to sleep before retrying a throttled segment page
+    :param buffer_size: max number of items fetched but not yet yielded, per segment if ordered. Segments
+      wait for room so memory use stays bounded.
+    :param kwargs: general arguments to operation
+    :return: generator of items returned by all segments
+    '''
+    if ordered:
+        queues = [queue.Queue(maxsize=buffer_size) for _ in range(segments)]
+    else:
+        queues = [queue.Queue(maxsize=buffer_size)] * segments
+    stopped = threading.Event()
+    segment_op = handling_too_many_requests(operation, sleep_amount=retry_sleep)
+
+    def put(value):
+        while not stopped.is_set():
+            try:
+                queues[value[0]].put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_segment(segment):
+        args = dict(kwargs)
+        args[segment_key] = segment
+        args[total_segments_key] = segments
+        try:
+            for item in do_all(segment_op, paging_key, result_key, argument_key=argument_key, **args):
+                if not put((segment, item)):
+                    return
+        except Exception as e:
+            put((segment, e))
         else:
-            done = True
+            put((segment, _segment_done))
+
+    executor = ThreadPoolExecutor(max_workers=segments)
+    for segment in range(segments):
+        executor.submit(run_segment, segment)
+    unfinished = segments
+    current = 0
+    try:
+        while unfinished:
+            segment, item = queues[current].get()
+            if isinstance(item, Exception):
+                raise item
+            if item is _segment_done:
+                unfinished -= 1
+                if ordered:
+                    current += 1
+            else:
+                yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
 
 
-def handling_too_many_requests(operation, sleep_amount=1.0):
+def handling_too_many_requests(operation, sleep_amount=1.0, policy=None):
     """
     Decorator for a fn that will retry if the TooManyRequestsException is thrown
     executing the function
     @param operation: the function wrapped
-    @param sleep_amount: number of seconds to sleep
+    @param sleep_amount: number of seconds to sleep if no policy is given
+    @param policy: optional sjautils.retry.RetryPolicy, e.g. for exponential backoff with jitter
+      and a limit on attempts. Defaults to retrying forever every sleep_amount seconds.
     @return the wrapped operation
     """
+    policy = policy or RetryPolicy(base=sleep_amount, cap=sleep_amount, multiplier=1, jitter=None)
 
     @wraps(operation)
     def retry(*args, **kwargs):
+        state = policy.begin()
+        while True:
+            try:
+                res = operation(*args, **kwargs)
+                state.succeeded()
+                return res
+            except Exception as e:
+                if e.__class__.__name__ != 'TooManyRequestsException':
+                    raise e
+                wait = state.next_wait(e)
+                if wait is None:
+                    raise e
+                time.sleep(wait)
+
+    return retry
+
+
+def ahandling_too_many_requests(operation, sleep_amount=1.0, policy=None):
+    """
+    Async version of handling_too_many_requests for an async operation
+    @return the wrapped operation
+    """
+    policy = policy or RetryPolicy(base=sleep_amount, cap=sleep_amount, multiplier=1, jitter=None)
+
+    @wraps(operation)
+    async def retry(*args, **kwargs):
+        state = policy.begin()
         while True:
             try:
-                return operation(*args, **kwargs)
+                res = await operation(*args, **kwargs)
+                state.succeeded()
+                return res
             except Exception as e:
-                if e.__class__.__name__ == 'TooManyRequestsException':
-                    time.sleep(sleep_amount)
-                else:
+                if e.__class__.__name__ != 'TooManyRequestsException':
+                    raise e
+                wait = state.next_wait(e)
+                if wait is None:
                     raise e
+                await asyncio.sleep(wait)
 
     return retry
 
 
+def _retriable(always_retry, retry_exceptions):
+    retriable_exceptions = [always_retry]
+    if retry_exceptions:
+        retriable_exceptions += list(retry_exceptions)
+    return retriable_exceptions
+
+
 def throttled_multi_op(operation, arg_items, always_retry='TooManyRequestsException', retry_exceptions=None,
                        sleep_some=1.0):
     """
@@ -73,11 +237,9 @@ def throttled_multi_op(operation, arg_items, always_retry='TooManyRequestsExcept
     @param sleep_some: seconds between retries
     @return None
     """
-    retriable_exceptions = [always_retry]
-    if retry_exceptions:
-        retriable_exceptions += list(retry_exceptions)
+    retriable_exceptions = _retriable(always_retry, retry_exceptions)
     remaining = deque(list(arg_items))
-    print('remaining', remaining, len(remaining))
+    logger.debug('%d items to do', len(remaining))
     while remaining:
         item = remaining.pop()
         logger.info('doing %s', item)
@@ -93,14 +255,199 @@ def throttled_multi_op(operation, arg_items, always_retry='TooManyRequestsExcept
                 raise e
 
 
-def composed_filter(gen, *filters):
+async def athrottled_multi_op(operation, arg_items, always_retry='TooManyRequestsException', retry_exceptions=None,
+                              sleep_some=1.0, max_concurrency=8, policy=None):
+    """
+    Async version of throttled_multi_op for an async operation.  Up to max_concurrency items are worked
+    on at once and an item hitting a retriable exception backs off with asyncio.sleep without holding up
+    the others.
+    @param operation: the async function of one argument to perform
+    @param arg_items: iterable of items to perform it over
+    @param always_retry: error name to always retry
+    @param retry_exceptions: names of other exceptions to always_retry
+    @param sleep_some: seconds between retries if no policy is given
+    @param max_concurrency: max number of operations running at once
+    @param policy: optional sjautils.retry.RetryPolicy for the backoff between retries of an item
+    @return async generator of operation results in order of completion
+    """
+    retriable_exceptions = _retriable(always_retry, retry_exceptions)
+    policy = policy or RetryPolicy(base=sleep_some, cap=sleep_some, multiplier=1, jitter=None)
+    limit = asyncio.Semaphore(max_concurrency)
+
+    async def do_item(item):
+        state = policy.begin()
+        while True:
+            async with limit:
+                logger.info('doing %s', item)
+                try:
+                    res = await operation(item)
+                    state.succeeded()
+                    return res
+                except Exception as e:
+                    logger.exception(e)
+                    if e.__class__.__name__ not in retriable_exceptions:
+                        raise e
+                    wait = state.next_wait(e)
+                    if wait is None:
+                        raise e
+            await asyncio.sleep(wait)
+
+    in_flight = set()
+    try:
+        for item in arg_items:
+            in_flight.add(asyncio.ensure_future(do_item(item)))
+            if len(in_flight) >= 2 * max_concurrency:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter.  Tokens are added at rate per second up to capacity and
+    each operation takes one, so bursts of up to capacity are allowed but the long run average
+    never exceeds rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens if available.
+        @return 0 if the tokens were taken else the seconds to wait before they could be
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until tokens are taken.
+        """
+        wait = self.try_acquire(tokens)
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire(tokens)
+
+    def on_success(self):
+        pass
+
+    def on_throttle(self):
+        pass
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    TokenBucket adjusting its rate AIMD style: additive increase on each success, multiplicative
+    decrease when throttled.  Throttles within cooldown seconds of the last decrease are taken to
+    be part of the same overload and do not decrease the rate again.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.5, max_rate=None, increase=0.1, decrease=0.5,
+                 cooldown=1.0):
+        super().__init__(rate, capacity)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or self.rate * 4
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._last_decrease = None
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._last_decrease and (now - self._last_decrease) < self.cooldown:
+                return
+            self._last_decrease = now
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+
+
+def concurrent_throttled_multi_op(operation, arg_items, rate=10.0, max_concurrency=8,
+                                  always_retry='TooManyRequestsException', retry_exceptions=None,
+                                  max_retries=10, limiter=None):
+    """
+    Concurrent version of throttled_multi_op.  Every call of operation first takes a token from a
+    shared limiter so the whole batch stays within the rate while up to max_concurrency calls are in
+    flight. A retriable exception tells the limiter to slow down and the item is retried on its own
+    without stalling the others.
+    @param operation: the function of one argument to perform
+    @param arg_items: iterable of items to perform it over. Consumed lazily.
+    @param rate: starting calls per second if no limiter is given
+    @param max_concurrency: max number of calls in flight
+    @param always_retry: error name to always retry
+    @param retry_exceptions: names of other exceptions to retry
+    @param max_retries: retries allowed per item before its last exception is raised
+    @param limiter: TokenBucket to use. Defaults to an AdaptiveTokenBucket starting at rate.
+    @return generator of operation results in order of completion
+    """
+    retriable_exceptions = _retriable(always_retry, retry_exceptions)
+    limiter = limiter or AdaptiveTokenBucket(rate)
+
+    def do_item(item):
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                res = operation(item)
+                limiter.on_success()
+                return res
+            except Exception as e:
+                if (e.__class__.__name__ not in retriable_exceptions) or (attempt >= max_retries):
+                    raise
+                attempt += 1
+                logger.info('retry %d of %s after %s', attempt, item, e.__class__.__name__)
+                limiter.on_throttle()
+
+    items = iter(arg_items)
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        try:
+            for item in items:
+                in_flight.add(executor.submit(do_item, item))
+                if len(in_flight) >= max_concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(in_flight):
+                yield future.result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def composed_filter(gen, *filters, reorder_sample=0):
     '''
     composition of filters in terms of generators although gen argument can all be any sequence.
-    composes use of filter functions by refining generator vs af function composition.
+    The filters are fused into a single test so each item is checked without a generator per filter.
     :param gen: generaror or other iternable
     :param filters: set of filter functions
+    :param reorder_sample: see utils.fused_filter
     :return: generator with only items that pass all filters
     '''
-    for f in filters:
-        gen = (g for g in gen if f(g))
-    return gen
+    test = fused_filter(*filters, reorder_sample=reorder_sample)
+    return (g for g in gen if test(g))
@@ -0,0 +1,182 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random, threading, time
+
+
+class CircuitOpenException(Exception):
+    def __init__(self, policy):
+        super().__init__('circuit open after %d consecutive failures' % policy.failures)
+
+
+class RetryPolicy:
+    '''
+    Shared description of how to retry something: exponential backoff with optional jitter, honouring
+    Retry-After information, limited by number of attempts and/or total elapsed time.  A policy can
+    also act as a circuit breaker shared by everything using it. After failure_threshold consecutive
+    failures the circuit opens and new calls fail fast with CircuitOpenException until reset_timeout
+    has passed, after which a single trial call is let through (half open) and others still fail fast
+    until it succeeds or fails.
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, base=1.0, cap=60.0, multiplier=2.0, jitter='full', max_attempts=None, max_elapsed=None,
+                 respect_retry_after=True, failure_threshold=None, reset_timeout=30.0):
+        '''
+        :param base: delay before the first retry
+        :param cap: max delay between attempts
+        :param multiplier: growth of the delay per attempt. 1 gives a fixed delay.
+        :param jitter: None, 'full', 'equal' or 'decorrelated'
+        :param max_attempts: max number of retries. None for no limit.
+        :param max_elapsed: max seconds from the first attempt to a retry. None for no limit.
+        :param respect_retry_after: use a Retry-After given by the server instead of the computed delay
+        :param failure_threshold: consecutive failures that open the circuit. None for no circuit breaking.
+        :param reset_timeout: seconds an open circuit waits before letting a trial call through
+        '''
+        if jitter not in (None, 'full', 'equal', 'decorrelated'):
+            raise ValueError('unknown jitter %s' % jitter)
+        self.base = base
+        self.cap = cap
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.max_elapsed = max_elapsed
+        self.respect_retry_after = respect_retry_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, previous=None):
+        '''
+        Delay before retry number attempt (starting at 0).
+        :param previous: the previous delay, used by decorrelated jitter
+        '''
+        if self.jitter == 'decorrelated':
+            previous = previous or self.base
+            return min(self.cap, random.uniform(self.base, previous * 3))
+        delay = min(self.cap, self.base * (self.multiplier ** attempt))
+        if self.jitter == 'full':
+            return random.uniform(0, delay)
+        if self.jitter == 'equal':
+            return delay / 2 + random.uniform(0, delay / 2)
+        return delay
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return self.CLOSED
+        if (now - self._opened_at) >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            now = time.monotonic()
+            half_open = self._state(now) == self.HALF_OPEN
+            if self.failure_threshold and (half_open or self.failures >= self.failure_threshold):
+                self._opened_at = now
+                self._trial_started = None
+
+    def begin(self):
+        '''
+        Starts retrying one call.
+        :return: RetryState for the call
+        :raises CircuitOpenException: if the circuit is open, or half open with a trial call under way.
+          A trial not resolved within reset_timeout is given up on and another allowed.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == self.HALF_OPEN:
+                trial = self._trial_started
+                if (trial is not None) and (now - trial) < self.reset_timeout:
+                    raise CircuitOpenException(self)
+                self._trial_started = now
+            elif state == self.OPEN:
+                raise CircuitOpenException(self)
+        return RetryState(self)
+
+
+class RetryState:
+    '''
+    Tracks attempts of one call made under a RetryPolicy.
+    '''
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempt = 0
+        self.started = time.monotonic()
+        self.previous = None
+
+    def next_wait(self, failure=None):
+        '''
+        Records a failed attempt and computes how long to wait before the next one.
+        :param failure: the exception or response that failed. Used to look for Retry-After.
+        :return: seconds to wait or None if no more retries should be made
+        '''
+        policy = self.policy
+        policy.record_failure()
+        if policy.max_attempts is not None and self.attempt >= policy.max_attempts:
+            return None
+        wait = retry_after(failure) if policy.respect_retry_after else None
+        if wait is None:
+            wait = policy.delay(self.attempt, self.previous)
+        if policy.max_elapsed is not None and (time.monotonic() - self.started + wait) > policy.max_elapsed:
+            return None
+        if policy.state == policy.OPEN:
+            return None
+        self.attempt += 1
+        self.previous = wait
+        return wait
+
+    def succeeded(self):
+        self.policy.record_success()
+
+
+def _headers(failure):
+    headers = getattr(failure, 'headers', None)
+    if headers is None:
+        response = getattr(failure, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if headers is None and isinstance(response, dict):  # botocore ClientError
+            headers = response.get('ResponseMetadata', {}).get('HTTPHeaders')
+    return headers
+
+
+def retry_after(failure):
+    '''
+    Seconds to wait according to the Retry-After header of a response or of an exception's response.
+    :param failure: response or exception
+    :return: seconds or None if no usable Retry-After is present
+    '''
+    headers = _headers(failure)
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
@@ -3,6 +3,8 @@ import random, re, os
 import validators
 import subprocess as sub
 from functools import reduce
+from types import MappingProxyType
+from sjautils.indexed import MultiIndexStore
 
 def pass_fail(items, test):
   passed = [], failed = []
@@ -28,39 +30,30 @@ def to_list(aDict):
       res.append(v)
   return res
 
-class ByNameId:
+class ByNameId(MultiIndexStore):
   '''
-  Provides by name and by id maps for dict like items that have both 'name' and '_id' fields
+  Provides by name and by id maps for dict like items that have both 'name' and '_id' fields.
+  An item added with a name already used by another item takes the name over.
   '''
+  __slots__ = ()
+
   def __init__(self, uses_name=True):
-    self._id_map = {}
-    self._name_map = {}
-    self._uses_name = uses_name
+    super().__init__('_id', *(('name',) if uses_name else ()), enforce_unique=False)
 
   def id_map(self):
-    return dict(self._id_map)
+    return self.unique_map('_id')
 
   def name_map(self):
-    return dict(self._name_map)
-
-  def values(self):
-    return self._id_map.values()
+    return self.unique_map('name') if 'name' in self._unique else MappingProxyType({})
 
   def add_item(self, item):
-    self._id_map[item['_id']] = item
-    if self._uses_name:
-      self._name_map[item['name']] = item
+    self.add(item)
 
   def with_id(self, an_id):
-    return self._id_map.get(an_id)
+    return self.get('_id', an_id)
 
   def with_name(self, name):
-    return self._name_map.get(name)
-
-  def random_instance(self):
-    vals = list(self._id_map.values())
-    index = random.randint(0, len(vals)-1)
-    return vals[index] if vals else None
+    return self.get('name', name) if 'name' in self._unique else None
 
 
 def as_list(fn, *args, **kwargs):
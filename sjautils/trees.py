@@ -4,6 +4,7 @@ from sjautils.class_utils import immediate_superclasses
 from sjautils.category import identity_function
 from sjautils.properties import reader, accessor
 from itertools import chain
+from array import array
 node_value = lambda x: x.value
 node_itself = identity_function
 
@@ -227,4 +228,187 @@ class BinaryTree(Tree):
         pass
 
 
+class CompactTree(object):
+    """
+    Forest stored as parallel arrays indexed by integer node id instead of Node objects: parent,
+    first child, next sibling and index of the node's value in a values list.  Roots are linked
+    as siblings of each other.  Traversals follow the links without recursion or, for pre and
+    post order, any stack.  Node functions given to the traversals take a node id.
+    """
+    NONE = -1
+
+    def __init__(self, intern_values=False):
+        """
+        :param intern_values: store equal (hashable) values once, sharing the value index
+        """
+        self._parent = array('q')
+        self._first_child = array('q')
+        self._next_sibling = array('q')
+        self._last_child = array('q')
+        self._value_index = array('q')
+        self._values = []
+        self._interned = {} if intern_values else None
+        self._first_root = self._last_root = self.NONE
+
+    def __len__(self):
+        return len(self._parent)
+
+    def _value_slot(self, value):
+        if self._interned is not None:
+            slot = self._interned.get(value)
+            if slot is None:
+                slot = self._interned[value] = len(self._values)
+                self._values.append(value)
+            return slot
+        self._values.append(value)
+        return len(self._values) - 1
+
+    def add(self, value, parent=None):
+        """
+        Adds a node as the last child of parent or as the last root if parent is None.
+        :return: the new node id
+        """
+        node = len(self._parent)
+        self._parent.append(self.NONE if parent is None else parent)
+        self._first_child.append(self.NONE)
+        self._next_sibling.append(self.NONE)
+        self._last_child.append(self.NONE)
+        self._value_index.append(self._value_slot(value))
+        self._link(node, parent)
+        return node
 
+    def _link(self, node, parent):
+        if parent is None:
+            if self._last_root == self.NONE:
+                self._first_root = node
+            else:
+                self._next_sibling[self._last_root] = node
+            self._last_root = node
+        else:
+            last = self._last_child[parent]
+            if last == self.NONE:
+                self._first_child[parent] = node
+            else:
+                self._next_sibling[last] = node
+            self._last_child[parent] = node
+
+    @classmethod
+    def from_parents(cls, records, key, parent_key, value=identity_function, intern_values=False):
+        """
+        Builds a tree in bulk from parent pointer records, e.g. rows of (id, parent_id, ...).
+        Records may come in any order; siblings keep their relative order among the records.
+        :param records: iterable of records
+        :param key: function giving a record's key
+        :param parent_key: function giving the key of a record's parent, None or unknown for roots
+        :param value: function giving the value to store for a record
+        :return: (tree, dict of record key to node id)
+        """
+        tree = cls(intern_values)
+        ids, parent_keys = {}, []
+        for node, record in enumerate(records):
+            ids[key(record)] = node
+            parent_keys.append(parent_key(record))
+            tree._value_index.append(tree._value_slot(value(record)))
+        n = len(parent_keys)
+        for arr in (tree._parent, tree._first_child, tree._next_sibling, tree._last_child):
+            arr.extend(array('q', [cls.NONE]) * n)
+        for node, pkey in enumerate(parent_keys):
+            parent = ids.get(pkey)
+            if parent is not None:
+                tree._parent[node] = parent
+            tree._link(node, parent)
+        if sum(1 for _ in tree.pre_order()) != n:
+            raise ValueError('parent pointers contain a cycle')
+        return tree, ids
+
+    @classmethod
+    def from_node(cls, node, intern_values=False):
+        """
+        :return: CompactTree with the same values and shape as the tree of Nodes under node
+        """
+        tree = cls(intern_values)
+        pending = [(node, None)]
+        while pending:
+            a_node, parent = pending.pop()
+            node_id = tree.add(a_node.value, parent)
+            pending.extend((child, node_id) for child in reversed(a_node._children) if child)
+        return tree
+
+    def value(self, node):
+        return self._values[self._value_index[node]]
+
+    def parent(self, node):
+        parent = self._parent[node]
+        return None if parent == self.NONE else parent
+
+    def children(self, node):
+        child = self._first_child[node]
+        while child != self.NONE:
+            yield child
+            child = self._next_sibling[child]
+
+    @property
+    def roots(self):
+        node = self._first_root
+        while node != self.NONE:
+            yield node
+            node = self._next_sibling[node]
+
+    def _start(self, root):
+        return self._first_root if root is None else root
+
+    def pre_order(self, result_modifier=identity_function, node_function=None, root=None):
+        """
+        :param root: node whose subtree to traverse, default all the trees
+        """
+        node_function = node_function or self.value
+        node, stop = self._start(root), root
+        first_child, next_sibling, parent = self._first_child, self._next_sibling, self._parent
+        while node != self.NONE:
+            yield result_modifier(node_function(node))
+            if first_child[node] != self.NONE:
+                node = first_child[node]
+                continue
+            while node != stop and next_sibling[node] == self.NONE:
+                node = parent[node]
+                if node == self.NONE:
+                    return
+            if node == stop:
+                return
+            node = next_sibling[node]
+
+    def post_order(self, result_modifier=identity_function, node_function=None, root=None):
+        node_function = node_function or self.value
+        node, stop = self._start(root), root
+        first_child, next_sibling, parent = self._first_child, self._next_sibling, self._parent
+        while node != self.NONE:
+            while first_child[node] != self.NONE:
+                node = first_child[node]
+            while True:
+                yield result_modifier(node_function(node))
+                if node == stop:
+                    return
+                if next_sibling[node] != self.NONE:
+                    node = next_sibling[node]
+                    break
+                node = parent[node]
+                if node == self.NONE:
+                    return
+
+    def in_order(self, result_modifier=identity_function, node_function=None, root=None):
+        """
+        As for BinaryNode.in_order the first half of a node's children (rounded up) come before
+        the node and the rest after it.
+        """
+        node_function = node_function or self.value
+        pending = [(node, False) for node in reversed(list(self.roots if root is None else [root]))]
+        while pending:
+            node, emit = pending.pop()
+            if emit:
+                yield result_modifier(node_function(node))
+                continue
+            children = list(self.children(node))
+            half = (len(children) + 1) // 2
+            pending.extend((child, False) for child in reversed(children[half:]))
+            pending.append((node, True))
+            pending.extend((child, False) for child in reversed(children[:half]))
@@ -1,10 +1,12 @@
 from decimal import Decimal
-from functools import reduce, wraps
+from functools import wraps
 import logging
+import operator
 from contextlib import contextmanager
 import re, time
 import os, types
 import asyncio
+import queue, threading
 import uuid
 
 def snake_to_camel_case(s, first_cap=False):
@@ -81,7 +83,18 @@ def asymmetric_next(next_name, next_indicator_name):
     return (next_name, lambda r: r.get(next_indicator_name))
 
 
-def get_all(fn, next_chunk_extractor, data_field, **kwargs):
+def _get_all_chunks(fn, next_key, next_val_fn, kwargs):
+    res = fn(**kwargs)
+    while True:
+        yield res
+        next_val = next_val_fn(res)
+        if next_val:
+            res = fn(**kwargs, **{next_key: next_val})
+        else:
+            break
+
+
+def get_all(fn, next_chunk_extractor, data_field, lookahead=0, **kwargs):
     '''
     Return a generator over all items returned by given function where the function
     may return items in chunks with some next indicator for more data available.
@@ -89,22 +102,129 @@ def get_all(fn, next_chunk_extractor, data_field, **kwargs):
     :param next_churk_extractor: 2-tuple of key for indicating to the function to return next chunk and
       function for getting next chunk value from current chunk
     :param data_field: key in chunk of the payload items return by fun
+    :param lookahead: if non-zero the next chunks are fetched on a background thread as soon as their
+      next indicator is known keeping at most this many chunks ahead of the consumer.
     :param kwargs: arguments to the function that are repeated per invocation
     :return generator over all items returned by fn
     '''
     next_key, next_val_fn = next_chunk_extractor
-    res = fn(**kwargs)
+    chunks = _get_all_chunks(fn, next_key, next_val_fn, kwargs)
+    if lookahead:
+        chunks = prefetched(chunks, lookahead)
+    for res in chunks:
+        yield from res.get(data_field, [])
+
+
+async def _aget_all_chunks(fn, next_key, next_val_fn, kwargs):
+    res = await fn(**kwargs)
     while True:
-        items = res.get(data_field, [])
-        for item in items:
-            yield item
+        yield res
         next_val = next_val_fn(res)
         if next_val:
-            res = fn(**kwargs, **{next_key: next_val})
+            res = await fn(**kwargs, **{next_key: next_val})
         else:
             break
 
 
+async def aget_all(fn, next_chunk_extractor, data_field, lookahead=1, **kwargs):
+    '''
+    Async version of get_all for an async fn.  Next chunks are requested by a separate task
+    as soon as their next indicator is known, at most lookahead chunks ahead of the consumer.
+    Pass lookahead=0 to fetch strictly on demand.
+    :return: async generator over all items returned by fn
+    '''
+    next_key, next_val_fn = next_chunk_extractor
+    chunks = _aget_all_chunks(fn, next_key, next_val_fn, kwargs)
+    if lookahead:
+        chunks = aprefetched(chunks, lookahead)
+    async for res in chunks:
+        for item in res.get(data_field, []):
+            yield item
+
+
+_prefetch_done = object()
+
+
+class _PrefetchError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetched(generator, lookahead=1):
+    '''
+    Runs generator on a background thread keeping up to lookahead of its values ready for the
+    consumer.  Exceptions raised by the generator are re-raised in the consumer after the values
+    produced before them.  Closing or abandoning the returned generator stops the background thread.
+    :param generator: generator or other iterable to run ahead
+    :param lookahead: max number of values produced but not yet consumed
+    :return: generator over the same values
+    '''
+    ready = queue.Queue(maxsize=max(1, lookahead))
+    stopped = threading.Event()
+
+    def put(value):
+        while not stopped.is_set():
+            try:
+                ready.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for value in generator:
+                if not put(value):
+                    return
+        except Exception as e:
+            put(_PrefetchError(e))
+        else:
+            put(_prefetch_done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            value = ready.get()
+            if value is _prefetch_done:
+                break
+            if isinstance(value, _PrefetchError):
+                raise value.exception
+            yield value
+    finally:
+        stopped.set()
+
+
+async def aprefetched(agenerator, lookahead=1):
+    '''
+    Async version of prefetched running an async generator in its own task.
+    :param agenerator: async generator or other async iterable to run ahead
+    :param lookahead: max number of values produced but not yet consumed
+    :return: async generator over the same values
+    '''
+    ready = asyncio.Queue(maxsize=max(1, lookahead))
+
+    async def produce():
+        try:
+            async for value in agenerator:
+                await ready.put(value)
+        except Exception as e:
+            await ready.put(_PrefetchError(e))
+        else:
+            await ready.put(_prefetch_done)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            value = await ready.get()
+            if value is _prefetch_done:
+                break
+            if isinstance(value, _PrefetchError):
+                raise value.exception
+            yield value
+    finally:
+        producer.cancel()
+
+
 def fixed_sleep_wait(fn, success_test, failed_test, seconds):
     '''
     Executes a function retrieving status of something that takes some time and
@@ -144,6 +264,133 @@ def group_by(size, sequence):
     if group:
         yield group
 
+
+class _GroupLimits:
+    '''
+    Book keeping for groups closed by whichever of item count, total size or age limit is hit first.
+    '''
+
+    def __init__(self, max_items=None, max_size=None, size_fn=len, max_seconds=None, reuse_buffer=False):
+        if not (max_items or max_size or max_seconds):
+            raise ValueError('at least one of max_items, max_size or max_seconds is required')
+        self.max_items = max_items
+        self.max_size = max_size
+        self.size_fn = size_fn if max_size else None
+        self.max_seconds = max_seconds
+        self.reuse_buffer = reuse_buffer
+        self.group = []
+        self.size = 0
+        self.started = None
+
+    def expired(self, now):
+        return bool(self.group and self.max_seconds and (now - self.started) >= self.max_seconds)
+
+    def time_left(self, now):
+        if not (self.group and self.max_seconds):
+            return None
+        return max(0.0, self.max_seconds - (now - self.started))
+
+    def fits(self, item_size):
+        '''
+        Whether an item of the given size can be added without passing max_size. An empty group always
+        accepts an item so oversized items still go out, alone.
+        '''
+        return not (self.group and self.max_size and (self.size + item_size > self.max_size))
+
+    def add(self, item, item_size, now):
+        if not self.group:
+            self.started = now
+        self.group.append(item)
+        self.size += item_size
+
+    def full(self):
+        if self.max_items and len(self.group) >= self.max_items:
+            return True
+        return bool(self.max_size and self.size >= self.max_size)
+
+    def take(self):
+        group = self.group
+        if not self.reuse_buffer:
+            self.group = []
+        self.size = 0
+        return group
+
+    def reset(self):
+        if self.reuse_buffer:
+            self.group.clear()
+
+
+def group_by_limits(sequence, max_items=None, max_size=None, size_fn=len, max_seconds=None, reuse_buffer=False):
+    '''
+    Grouping generator that closes a group on whichever comes first: max_items items, a total
+    size of max_size as measured by size_fn, or the group being max_seconds old. Handy for
+    batching to endpoints with byte limits, e.g. size_fn=lambda i: len(json.dumps(i)).
+    :param sequence: sequence or generator to group
+    :param max_items: max number of items in a group
+    :param max_size: max total size of a group. An item bigger than this on its own is yielded alone.
+    :param size_fn: function giving the size of an item. Only called if max_size is given.
+    :param max_seconds: max age of a group.  As this is synchronous the age is only checked when the
+      next item arrives.  Use agroup_by_limits for timer based flushing.
+    :param reuse_buffer: if True the same list is cleared and refilled for every group so the consumer
+      must copy a group it wants to keep past the next iteration.
+    :return: yields groups until sequence is exhausted
+    '''
+    limits = _GroupLimits(max_items, max_size, size_fn, max_seconds, reuse_buffer)
+    for item in sequence:
+        now = time.monotonic()
+        item_size = limits.size_fn(item) if limits.size_fn else 0
+        if limits.expired(now) or not limits.fits(item_size):
+            yield limits.take()
+            limits.reset()
+        limits.add(item, item_size, now)
+        if limits.full():
+            yield limits.take()
+            limits.reset()
+    if limits.group:
+        yield limits.take()
+
+
+async def agroup_by_limits(aiterable, max_items=None, max_size=None, size_fn=len, max_seconds=None,
+                           reuse_buffer=False):
+    '''
+    Async version of group_by_limits over an async iterable. Here max_seconds is enforced by a timer
+    so a partial group is flushed when it gets old even if no new item has arrived.
+    :return: async generator of groups
+    '''
+    limits = _GroupLimits(max_items, max_size, size_fn, max_seconds, reuse_buffer)
+    items = aiterable.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(items.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=limits.time_left(time.monotonic()))
+            if not done:
+                yield limits.take()
+                limits.reset()
+                continue
+            try:
+                item = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            now = time.monotonic()
+            item_size = limits.size_fn(item) if limits.size_fn else 0
+            if limits.expired(now) or not limits.fits(item_size):
+                yield limits.take()
+                limits.reset()
+            limits.add(item, item_size, now)
+            if limits.full():
+                yield limits.take()
+                limits.reset()
+        if limits.group:
+            yield limits.take()
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
 def filter_until_failure(sequence, test):
     for item in sequence:
         if test(item):
@@ -170,11 +417,123 @@ def gen_filter(sequence, test, stop_on_fail=False):
     return list(generator) if is_list else generator
 
 
-def equality_filter(generator, **field_values):
+def field_equals(**field_values):
+    '''
+    Predicate for dict items having the given field values, missing fields counting as None.
+    All fields are fetched at once with an itemgetter and compared as a tuple.
+    :param field_values: field names and the values they must equal
+    :return: function of an item returning whether it matches
+    '''
+    if not field_values:
+        return lambda item: True
+    getter = operator.itemgetter(*field_values.keys())
+    expected = tuple(field_values.values())
+    if len(expected) == 1:
+        expected = expected[0]
+
     def test(item):
-        return all([(item.get(k) == v) for k, v in field_values.items()])
+        try:
+            return getter(item) == expected
+        except KeyError:
+            return all(item.get(k) == v for k, v in field_values.items())
+
+    return test
 
-    return gen_filter(generator, test)
+
+def _and_of(predicates):
+    '''
+    compiles predicates into a single short circuiting function with no per item loop
+    '''
+    if not predicates:
+        return lambda item: True
+    if len(predicates) == 1:
+        return predicates[0]
+    names = {'p%d' % i: p for i, p in enumerate(predicates)}
+    body = ' and '.join('%s(item)' % n for n in names)
+    return eval('lambda item: bool(%s)' % body, names)
+
+
+class _ReorderingPredicate:
+    '''
+    Conjunction of predicates that times the predicates on the first sample_size items and then
+    recompiles itself with the predicates that cheaply reject the most items first.  Sampling
+    short-circuits like the compiled test, so only predicates actually reached are timed.  If the
+    reordered test raises (a predicate moved before the one guarding it) the declared order is
+    restored for good and the item tested again.
+    '''
+
+    def __init__(self, predicates, sample_size):
+        self._predicates = list(predicates)
+        self._declared = self._predicates
+        self._sample_size = sample_size
+        self._seen = 0
+        self._costs = [0.0] * len(self._predicates)
+        self._reached = [0] * len(self._predicates)
+        self._rejects = [0] * len(self._predicates)
+        self._test = None
+
+    def __call__(self, item):
+        if self._test:
+            try:
+                return self._test(item)
+            except Exception:
+                if self._predicates is self._declared:
+                    raise
+                self._predicates = self._declared
+                self._test = _and_of(self._declared)
+                return self._test(item)
+        ok = True
+        for i, pred in enumerate(self._predicates):
+            start = time.perf_counter()
+            passed = pred(item)
+            self._costs[i] += time.perf_counter() - start
+            self._reached[i] += 1
+            if not passed:
+                self._rejects[i] += 1
+                ok = False
+                break
+        self._seen += 1
+        if self._seen >= self._sample_size:
+            self._reorder()
+        return ok
+
+    def _reorder(self):
+        def rank(i):
+            # unreached or never rejecting predicates keep their relative order at the end
+            reached = self._reached[i]
+            if not (reached and self._rejects[i]):
+                return float('inf')
+            return (self._costs[i] / reached) / (self._rejects[i] / reached)
+
+        order = sorted(range(len(self._predicates)), key=rank)
+        if order != sorted(order):
+            self._predicates = [self._predicates[i] for i in order]
+        self._test = _and_of(self._predicates)
+
+
+def fused_filter(*predicates, reorder_sample=0, **field_values):
+    '''
+    Fuses predicates into a single callable that is true when all are.
+    :param predicates: functions of one item
+    :param reorder_sample: if non-zero the predicates are timed over this many items and then
+      reordered so the ones rejecting most items per unit of cost run first.  Reordering assumes the
+      predicates are independent and total (each can be called on any item without raising).  A
+      predicate guarded by an earlier one may be moved before its guard, in which case the first
+      exception it raises makes the filter go back to the given order.
+    :param field_values: field equality tests as for equality_filter. These are combined into one
+      itemgetter based test that is run first.
+    :return: the fused predicate
+    '''
+    predicates = list(predicates)
+    if field_values:
+        predicates.insert(0, field_equals(**field_values))
+    if reorder_sample and len(predicates) > 1:
+        return _ReorderingPredicate(predicates, reorder_sample)
+    return _and_of(predicates)
+
+
+def equality_filter(generator, **field_values):
+    return gen_filter(generator, field_equals(**field_values))
 
 
 def walkup(start):
@@ -232,49 +591,182 @@ def async_wrapper(coro):
 
 
 
-def value_fixer(value_test, fix):
+_DICT, _LIST, _TUPLE, _GENERATOR = 'dict', 'list', 'tuple', 'generator'
+_kinds = {dict: _DICT, list: _LIST, tuple: _TUPLE, types.GeneratorType: _GENERATOR}
+_dropped = object()
+
+
+def _kind(obj):
+    '''
+    container kind of obj or None for scalars, looked up by exact type and remembered for subclasses.
+    '''
+    obj_type = type(obj)
+    try:
+        return _kinds[obj_type]
+    except KeyError:
+        pass
+    kind = None
+    for base, base_kind in ((dict, _DICT), (list, _LIST), (tuple, _TUPLE)):
+        if isinstance(obj, base):
+            kind = base_kind
+            break
+    _kinds[obj_type] = kind
+    return kind
+
+
+class Transformer:
+    '''
+    Transforms nested dicts, lists, tuples and generators in one iterative traversal, so deep structures
+    do not hit the recursion limit. Scalars are fixed by the fix function for their type, if any, then by
+    any (value_test, fix) pairs. Scalars and rebuilt containers satisfying drop_test are dropped.  Several
+    transformers can be fused with combine into one that does all their work in a single pass.
+    '''
+
+    def __init__(self, type_fixes=None, value_fixes=(), drop_test=None, in_place=False):
+        '''
+        :param type_fixes: dict of scalar type to the function fixing instances of that type, subclasses included
+        :param value_fixes: sequence of (value_test, fix) pairs applied to scalars after any type fix
+        :param drop_test: optional test for values, including rebuilt containers, to drop
+        :param in_place: if True dicts and lists are updated in place rather than copied
+        '''
+        self.type_fixes = dict(type_fixes or {})
+        self._resolved = dict(self.type_fixes)
+        self.value_fixes = list(value_fixes)
+        self.drop_test = drop_test
+        self.in_place = in_place
+
+    def combine(self, *others, in_place=None):
+        '''
+        :return: a Transformer doing the work of this one and others in a single traversal. Type fixes of
+          later transformers win for the same type.
+        '''
+        type_fixes, value_fixes, drop_tests = dict(self.type_fixes), list(self.value_fixes), [self.drop_test]
+        for other in others:
+            type_fixes.update(other.type_fixes)
+            value_fixes.extend(other.value_fixes)
+            drop_tests.append(other.drop_test)
+        drop_tests = [d for d in drop_tests if d]
+        drop_test = (lambda v: any(d(v) for d in drop_tests)) if len(drop_tests) > 1 else (drop_tests or [None])[0]
+        return Transformer(type_fixes, value_fixes, drop_test, self.in_place if in_place is None else in_place)
+
+    def fix_for(self, value_type):
+        '''
+        :return: the fix for values of value_type or None. Looked up by exact type first; other types are
+          resolved by isinstance against type_fixes (earliest given wins) once and remembered.
+        '''
+        try:
+            return self._resolved[value_type]
+        except KeyError:
+            pass
+        fix = next((f for t, f in self.type_fixes.items() if issubclass(value_type, t)), None)
+        self._resolved[value_type] = fix
+        return fix
+
+    def _fix_scalar(self, value):
+        fix = self.fix_for(type(value))
+        if fix is not None:
+            value = fix(value)
+        for test, fix in self.value_fixes:
+            if test(value):
+                value = fix(value)
+        if self.drop_test is not None and self.drop_test(value):
+            return _dropped
+        return value
+
+    def _frame(self, obj, kind, key):
+        items = obj.items() if kind == _DICT else enumerate(obj)
+        out = {} if kind == _DICT else []
+        return kind, iter(items), out, key, obj
+
+    def _finish(self, kind, out, src):
+        if kind == _TUPLE:
+            out = tuple(out)
+        elif self.in_place and kind == _LIST:
+            src[:] = out
+            out = src
+        elif self.in_place:
+            if len(out) != len(src):
+                for k in [k for k in src if k not in out]:
+                    del src[k]
+            src.update(out)
+            out = src
+        if self.drop_test is not None and self.drop_test(out):
+            return _dropped
+        return out
+
+    def _transform(self, obj):
+        kind = _kind(obj)
+        if kind is None:
+            return self._fix_scalar(obj)
+        if kind == _GENERATOR:
+            return (v for v in map(self._transform, obj) if v is not _dropped)
+        stack = [self._frame(obj, kind, None)]
+        while True:
+            kind, items, out, key, src = stack[-1]
+            is_dict = kind == _DICT
+            for k, v in items:
+                v_kind = _kind(v)
+                if v_kind is None:
+                    v = self._fix_scalar(v)
+                elif v_kind == _GENERATOR:
+                    v = self._transform(v)
+                else:
+                    stack.append(self._frame(v, v_kind, k))
+                    break
+                if v is not _dropped:
+                    if is_dict:
+                        out[k] = v
+                    else:
+                        out.append(v)
+            else:
+                stack.pop()
+                result = self._finish(kind, out, src)
+                if not stack:
+                    return result
+                if result is not _dropped:
+                    parent_out = stack[-1][2]
+                    if stack[-1][0] == _DICT:
+                        parent_out[key] = result
+                    else:
+                        parent_out.append(result)
+
+    def __call__(self, obj):
+        res = self._transform(obj)
+        return None if res is _dropped else res
+
+    def stream(self, obj):
+        '''
+        Generator of the transformed top level elements of a list, tuple or other iterable, skipping
+        dropped ones.  Lets large result sets be transformed lazily element by element.
+        '''
+        for item in obj:
+            res = self._transform(item)
+            if res is not _dropped:
+                yield res
+
+
+def value_fixer(value_test, fix, fix_type=None):
     '''
     Generalized value fixer
     :param value_test: tests for whether a scalar value needs fixing
     :param fix: function that fixes the value
+    :param fix_type: optional type of the values needing fixing, equivalent to a value_test of
+      isinstance(value, fix_type). If given it replaces value_test with a per type lookup.
     :returns: function for fixing the object by these criteria which creats a new fixed object
     '''
-
-    def fix_it(obj):
-        if isinstance(obj, dict):
-            return {k: fix_it(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [fix_it(v) for v in obj]
-        elif isinstance(obj, tuple):
-            return tuple([fix_it(v) for v in obj])
-        elif isinstance(obj, types.GeneratorType):
-            return (fix_it(v) for v in obj)
-        else:
-            return fix(obj) if value_test(obj) else obj
-
-    return fix_it
+    if fix_type is not None:
+        return Transformer(type_fixes={fix_type: fix})
+    return Transformer(value_fixes=[(value_test, fix)])
 
 
 def value_dropper(drop_test, sentinel=None):
-    if sentinel is None:
-        sentinel = uuid.uuid4().hex
-    to_be_discarded = lambda x: (x == sentinel) or drop_test(x)
-
-    def drop_filtered(obj):
-        temp = obj
-        if isinstance(obj, dict):
-            temp = {k: v for k, v in {k: drop_filtered(v) for k, v in obj.items()}.items() if not to_be_discarded(v)}
-        elif isinstance(obj, list) or isinstance(obj, tuple):
-            temp = [i for i in [drop_filtered(l) for l in obj] if not to_be_discarded(i)]
-            if isinstance(obj, tuple):
-                temp = tuple(temp)
-        return sentinel if drop_test(temp) else temp
-
-    def drop_bad_values(obj):
-        filtered = drop_filtered(obj)
-        return None if (filtered == sentinel) else filtered
-
-    return drop_bad_values
+    '''
+    Generalized value dropper
+    :param drop_test: tests for whether a scalar value or a container, after dropping from it, should be dropped
+    :param sentinel: no longer used, kept for compatibility
+    :returns: function returning a copy of the object without the dropped values, None if the object itself is dropped
+    '''
+    return Transformer(drop_test=drop_test)
 
 
 def decimal_fix(d):
@@ -285,32 +777,118 @@ def to_decimal(d):
     return Decimal(str(d)) if isinstance(d, float) else d
 
 
-decimal_fixer = value_fixer(value_test=lambda o: isinstance(o, Decimal), fix=decimal_fix)
-decimal_input_fix = value_fixer(value_test=lambda o: isinstance(o, float), fix=to_decimal)
+decimal_fixer = value_fixer(value_test=lambda o: isinstance(o, Decimal), fix=decimal_fix, fix_type=Decimal)
+decimal_input_fix = value_fixer(value_test=lambda o: isinstance(o, float), fix=to_decimal, fix_type=float)
 remove_falsey = value_dropper(drop_test=lambda o: o == '')
-float_to_int = value_fixer(value_test=lambda o: isinstance(o, float), fix=int)
+float_to_int = value_fixer(value_test=lambda o: isinstance(o, float), fix=int, fix_type=float)
 
 clear_dict = remove_falsey
 remdec = decimal_fixer
 
 
+class ShapeConverter:
+    '''
+    Converts scalar values of dict items by type as a Transformer does, but caches per item shape
+    (keys and value types) which keys need converting.  Flat items are then converted with a dict copy
+    and one call per converted value.  Items with nested containers go through the full Transformer.
+    Flat items needing no conversion are returned as is.
+    '''
+
+    def __init__(self, type_fixes, max_shapes=1024):
+        self._transformer = Transformer(type_fixes=type_fixes)
+        self._plans = {}
+        self._max_shapes = max_shapes
+
+    def _plan(self, item):
+        shape = (tuple(item), tuple(map(type, item.values())))
+        plan = self._plans.get(shape)
+        if plan is None:
+            if any(_kind(v) for v in item.values()):
+                plan = False
+            else:
+                fix_for = self._transformer.fix_for
+                plan = tuple((k, fix) for k, fix in zip(shape[0], map(fix_for, shape[1])) if fix is not None)
+            if len(self._plans) >= self._max_shapes:
+                self._plans.clear()
+            self._plans[shape] = plan
+        return plan
+
+    def __call__(self, item):
+        if type(item) is not dict:
+            return self._transformer(item)
+        plan = self._plan(item)
+        if plan is False:
+            return self._transformer(item)
+        if not plan:
+            return item
+        out = item.copy()
+        for k, fix in plan:
+            out[k] = fix(out[k])
+        return out
+
+    def stream(self, items):
+        '''
+        Lazily converts each item of a generator such as get_all or paging.do_all returns.
+        '''
+        return map(self, items)
+
+
+decimal_item_fixer = ShapeConverter({Decimal: decimal_fix})
+decimal_item_input_fix = ShapeConverter({float: to_decimal})
+
+
+def decimal_fixed_stream(items):
+    '''
+    decimal_fixer applied lazily to each item of a stream of items, e.g. read from DynamoDB
+    '''
+    return decimal_item_fixer.stream(items)
+
+
+def decimal_input_stream(items):
+    '''
+    decimal_input_fix applied lazily to each item of a stream of items, e.g. to be written to DynamoDB
+    '''
+    return decimal_item_input_fix.stream(items)
+
+
+def decimal_columns(items, *fields):
+    '''
+    Batch conversion of numeric fields of items into NumPy float arrays, NaN where a field is missing.
+    Requires numpy.
+    :param items: iterable of dict items, e.g. from DynamoDB
+    :param fields: names of the numeric fields to extract
+    :return: dict of field name to float64 array
+    '''
+    import numpy as np
+    items = items if isinstance(items, list) else list(items)
+    nan = float('nan')
+    return {f: np.fromiter((float(v) if (v := i.get(f)) is not None else nan for i in items),
+                           dtype=np.float64, count=len(items))
+            for f in fields}
+
+
+def float_column_to_decimals(column):
+    '''
+    Batch conversion of a NumPy float array (or any sequence of floats) to Decimals suitable for DynamoDB.
+    NaN values become None.  The shortest round tripping repr of each float is used, as in to_decimal.
+    '''
+    return [None if f != f else Decimal(repr(f)) for f in map(float, column)]
+
+
 def simply_flatten(obj):
     '''
     returns a list of the scalar leaf objects.
     '''
     flat = []
-
-    def flatten(x):
+    stack = [obj]
+    while stack:
+        x = stack.pop()
         if isinstance(x, dict):
-            for v in x.values():
-                flatten(v)
-        elif isinstance(x, list) or isinstance(x, tuple):
-            for v in x:
-                flatten(v)
+            stack.extend(reversed(list(x.values())))
+        elif isinstance(x, (list, tuple)):
+            stack.extend(reversed(x))
         else:
             flat.append(x)
-
-    flatten(obj)
     return flat
 
 
@@ -324,34 +902,27 @@ def drop_word(s, break_fn):
     return s[:index]
 
 
+_default_word = re.compile(r'[^\W_]+')
+_url_line = re.compile(r'^https?:\/\/.*[\r\n]*', flags=re.MULTILINE)
+
+
+def _word_pattern(s, test):
+    '''
+    regex matching runs of characters of s that are not word breaks according to test. test is only
+    called once per distinct character.  None means words are runs of alphanumeric characters.
+    '''
+    if test is None:
+        return _default_word
+    breaks = ''.join(c for c in set(s) if test(c))
+    return re.compile('[^%s]+' % re.escape(breaks)) if breaks else re.compile('.+', flags=re.DOTALL)
+
+
 def word_splitter(s, test):
-    in_word = False
-    word_start = -1
-    res = []
-    for i, c in enumerate(s):
-        if test(c):
-            if in_word:
-                res.append(s[word_start: i])
-            in_word = False
-        else:
-            if not in_word:
-                in_word = True
-                word_start = i
-    if in_word:
-        res.append(s[word_start:])
-    return res
+    return _word_pattern(s, test).findall(s)
 
 
 def word_indices(a_string, break_fn):
-    words = word_splitter(a_string, break_fn)
-    word_locations = []
-    begin = 0
-    for word in words:
-        start = begin + a_string[begin:].index(word)
-        end = start + len(word)
-        word_locations.append((start, end))
-        begin = end
-    return word_locations
+    return [m.span() for m in _word_pattern(a_string, break_fn).finditer(a_string)]
 
 
 def max_word_break(a_string, max_length, break_fn):
@@ -360,37 +931,44 @@ def max_word_break(a_string, max_length, break_fn):
     possible.  Words are considere separated by <space>. if no <space> in a_string return the
     truncated string
     '''
-
-    word_locs = word_indices(a_string, break_fn)
+    if max_length <= 0:
+        return a_string[:max_length]
+    pattern = _word_pattern(a_string, break_fn)
     last = 0
-    for _, end in word_locs:
-        if end <= max_length:
-            last = end
-        else:
-            break
+    previous = 0
+    for match in pattern.finditer(a_string, 0, max_length):
+        previous, last = last, match.end()
+    if last == max_length and last < len(a_string):
+        # the last word found may be cut short by max_length
+        continued = pattern.match(a_string, last - 1, last + 1)
+        if continued is not None and continued.end() > last:
+            last = previous
     return a_string[:last] if last else a_string[:max_length]
 
 
 def truncate_text(text, length=100, strict=False, elipses=False, quotes=False, removeurls=True, word_break=None):
-    word_break = word_break or (lambda c: not c.isalnum())
     if removeurls:
-        text = re.sub(r'^https?:\/\/.*[\r\n]*', '', text, flags=re.MULTILINE)
-    add_elipses = lambda s: s + '...'
-    add_quotes = lambda s: '"%s"' % s
-    decorations = []
+        text = _url_line.sub('', text)
     if elipses:
-        decorations.append(add_elipses)
         length -= 3
     if quotes:
-        decorations.append(add_quotes)
         length -= 2
+    res = text[:length] if strict else max_word_break(text, length, word_break)
+    if elipses:
+        res += '...'
+    if quotes:
+        res = '"%s"' % res
+    return res
 
-    decorated = lambda s: reduce(lambda a, d: d(a), decorations, s)
 
-    if strict:
-        return decorated(text[:length])
-    else:
-        return decorated(max_word_break(text, length, word_break))
+def truncate_many(texts, length=100, **kwargs):
+    '''
+    truncate_text for many texts at once, e.g. all the snippets of a page.
+    :param texts: iterable of texts
+    :param kwargs: other truncate_text options
+    :return: list of truncated texts
+    '''
+    return [truncate_text(t, length, **kwargs) for t in texts]
 
 
 def adder_if(target, is_valid=None):
@@ -1,5 +1,10 @@
-from functools import reduce
-import pytz
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, reduce, update_wrapper
+from types import MappingProxyType
+import difflib
+import multiprocessing
+import re
 from sjautils import utils
 from sjautils.date_time import timestamp
 import validators
@@ -35,6 +40,16 @@ class ValidationException(Exception):
             message = message.format(**msg_parameters)
         super().__init__(message)
 
+    def __reduce__(self):
+        # subclasses take specs and values rather than the message so rebuild from the message when unpickling
+        return _rebuilt_exception, (self.__class__, str(self))
+
+
+def _rebuilt_exception(cls, message):
+    e = cls.__new__(cls)
+    Exception.__init__(e, message)
+    return e
+
 
 class MissingRequiredException(ValidationException):
     def __init__(self, missing):
@@ -46,6 +61,64 @@ class UniquenessException(ValidationException):
         super().__init__('Field %s has non-unique value %s' % (field, value))
 
 
+class MemoizedValidation:
+    '''
+    Wraps a validation_fn with a bounded LRU cache of its results by value, for validators that see the same
+    values over and over.  As fn only returns (validators module functions return a falsy failure rather
+    than raising) results can be cached whatever they are.  Exceptions are not cached.  Has the name of fn
+    and pickles if fn and prefilter do.
+    '''
+
+    def __init__(self, fn, max_size=1024, prefilter=None):
+        '''
+        :param fn: the validation function of one value
+        :param max_size: max number of values to remember, 0 for none
+        :param prefilter: optional cheap function of the value returning False for values fn certainly rejects.
+          These get False without calling fn or using the cache.
+        '''
+        update_wrapper(self, fn)
+        self.fn = fn
+        self.max_size = max_size
+        self.prefilter = prefilter
+        self._results = {}
+        self.hits = self.misses = self.rejected = 0
+
+    def __call__(self, val):
+        if (self.prefilter is not None) and not self.prefilter(val):
+            self.rejected += 1
+            return False
+        results = self._results
+        try:
+            result = results.pop(val)
+        except KeyError:
+            self.misses += 1
+            result = self.fn(val)
+            if not self.max_size:
+                return result
+            if len(results) >= self.max_size:
+                results.pop(next(iter(results), None), None)
+        else:
+            self.hits += 1
+        results[val] = result  # most recently used last
+        return result
+
+    def cache_clear(self):
+        self._results.clear()
+
+    def stats(self):
+        '''
+        :return: dict of hits, misses, hit_rate, size, max_size and rejected (by prefilter)
+        '''
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=(self.hits / lookups) if lookups else 0.0,
+                    size=len(self._results), max_size=self.max_size, rejected=self.rejected)
+
+
+# necessary but not sufficient forms of urls and emails, quick to rule out junk
+plausible_url = re.compile(r'[^\s:/]+://\S+\Z').match
+plausible_email = re.compile(r'[^\s@]+@[^\s@]+\.\S+\Z').match
+
+
 class ParamSpec:
     '''
     Superclass of all classes specifying name, type and other legal value checks for parameters/fields.
@@ -69,7 +142,11 @@ class ParamSpec:
 
     class EnumException(ValidationException):
         def __init__(self, spec, val):
-            super().__init__('enum field %s must be one of %s not %s' % (spec.name, str(spec.legal_values), val))
+            msg = 'enum field %s must be one of %s not %s' % (spec.name, str(spec.declared_values), val)
+            suggestion = spec.closest(val)
+            if suggestion is not None:
+                msg += ' (did you mean %s?)' % suggestion
+            super().__init__(msg)
 
     def __init__(self, name, param_type, description, optional=True, default_val=None, default_fn=None,
                  special_fill_fn=None, external_update_fn=None, required=False):
@@ -159,6 +236,53 @@ class ParamSpec:
         if self.check_existence(val):
             return self.check_type(val)
 
+    def _compiled(self, name, compiled_name):
+        '''
+        Returns the closure built by method compiled_name if it is the one matching method name for this
+        spec, otherwise (a subclass overrides name without a compiled version) the bound method name.
+        '''
+        for cls in type(self).__mro__:
+            if compiled_name in cls.__dict__:
+                return getattr(self, compiled_name)()
+            if name in cls.__dict__:
+                return getattr(self, name)
+
+    def _compiled_exists(self):
+        return lambda val: val is not None
+
+    def _compiled_type_check(self):
+        spec, param_type, type_exception = self, self.param_type, self.TypeException
+
+        def check_type(val):
+            if not isinstance(val, param_type):
+                raise type_exception(spec, val)
+            return True
+
+        return check_type
+
+    def _compiled_check(self):
+        spec, required_exception = self, self.RequiredException
+        exists = self._compiled('exists', '_compiled_exists')
+        check_type = self._compiled('check_type', '_compiled_type_check')
+        if self.optional:
+            def check(val):
+                if val is None:
+                    return True
+                return check_type(val)
+        else:
+            def check(val):
+                if not exists(val):
+                    raise required_exception(spec)
+                return check_type(val)
+        return check
+
+    def compiled_check(self):
+        '''
+        :return: function of a value doing what check_basic_validity does with the attribute lookups and
+          method dispatch done once up front.
+        '''
+        return self._compiled('check_basic_validity', '_compiled_check')
+
 
 class Derived(ParamSpec):
     '''
@@ -222,8 +346,10 @@ class String(ParamSpec):
     '''
     Superclass of String type fields.
     '''
+    default_prefilter = None
 
-    def __init__(self, name, description, empty_allowed=True, validation_fn=None, unique=False, **kwargs):
+    def __init__(self, name, description, empty_allowed=True, validation_fn=None, unique=False, memoize=None,
+                 prefilter=None, **kwargs):
         '''
 
         :param name: See super
@@ -232,13 +358,26 @@ class String(ParamSpec):
         :param validation_fn: An additional optional function for validation of value. Takes one param - a value to
            check. The function should return True if there was no problem or raise if there was a problem.
         :param unique: whether uniqueness is required, typically only for Persistent table/collection checks
+        :param memoize: if given, max number of values to cache validation_fn results for (see MemoizedValidation)
+        :param prefilter: cheap check for values validation_fn would certainly reject (see MemoizedValidation).
+          Defaults to the class's default_prefilter when memoizing.
         :param kwargs: See super
         '''
         super().__init__(name, str, description, **kwargs)
         self.empty_allowed = empty_allowed
+        if validation_fn and (memoize or prefilter):
+            validation_fn = MemoizedValidation(validation_fn, max_size=memoize or 0,
+                                               prefilter=prefilter or self.default_prefilter)
         self._validation_fn = validation_fn
         self.unique = unique
 
+    def validation_stats(self):
+        '''
+        :return: MemoizedValidation.stats of a memoized validation_fn, else None
+        '''
+        if isinstance(self._validation_fn, MemoizedValidation):
+            return self._validation_fn.stats()
+
     def exists(self, val):
         return super().exists(val) if self.empty_allowed else bool(val)
 
@@ -259,11 +398,31 @@ class String(ParamSpec):
                     raise self.SpecificTypeException(self, self._validation_fn.__name__, val)
         return True
 
+    def _compiled_exists(self):
+        return super()._compiled_exists() if self.empty_allowed else bool
+
+    def _compiled_type_check(self):
+        base = super()._compiled_type_check()
+        validation_fn = self._validation_fn
+        if not validation_fn:
+            return base
+        spec, specific_exception = self, self.SpecificTypeException
+
+        def check_type(val):
+            base(val)
+            try:
+                return validation_fn(val)
+            except Exception as e:
+                raise specific_exception(spec, validation_fn.__name__, val)
+
+        return check_type
+
 
 class URL(String):
     '''
     Spec for URL type using validators module
     '''
+    default_prefilter = plausible_url
 
     def __init__(self, name, description, empty_allowed=False, validation_fn=validators.url, **kwargs):
         super().__init__(name, description, empty_allowed=empty_allowed, validation_fn=validation_fn, **kwargs)
@@ -277,6 +436,7 @@ class Email(String):
     '''
     Spec for email type using validators module
     '''
+    default_prefilter = plausible_email
 
     def __init__(self, name, description, empty_allowed=False, validation_fn=validators.email, **kwargs):
         super().__init__(name, description, empty_allowed=empty_allowed, validation_fn=validation_fn, **kwargs)
@@ -286,22 +446,112 @@ class EnumString(String):
     '''
     Spec for Enum type that ensures value is one of the allowed string values.
     '''
+    max_suggestions = 256  # closest matches remembered for error messages
 
-    def __init__(self, name, description, legal_values, empty_allowed=False, **kwargs):
+    def __init__(self, name, description, legal_values, empty_allowed=False, case_insensitive=False, **kwargs):
+        '''
+        :param legal_values: container of the legal values or niladic function returning it, called on first use.
+          Membership is checked against a frozenset of them.
+        :param case_insensitive: whether values differing from a legal value only in case are legal
+        '''
         super().__init__(name, description, empty_allowed=empty_allowed, **kwargs)
+        self.case_insensitive = case_insensitive
         self.legal_values = legal_values
 
+    @property
+    def declared_values(self):
+        '''the legal values as given, used in messages'''
+        if callable(self._declared):
+            self._declared = self._declared()
+        return self._declared
+
+    @property
+    def legal_values(self):
+        if self._legal is None:
+            self._legal = frozenset(self.declared_values)
+        return self._legal
+
+    @legal_values.setter
+    def legal_values(self, values):
+        self._declared = values
+        self._legal = None
+        self._folded = None
+        self._closest = {}
+
+    def folded_values(self):
+        '''
+        :return: dict of casefolded legal value to legal value
+        '''
+        if self._folded is None:
+            self._folded = {v.casefold(): v for v in self.declared_values}
+        return self._folded
+
+    def is_legal(self, val):
+        return (val in self.legal_values) or (self.case_insensitive and val.casefold() in self.folded_values())
+
+    def closest(self, val):
+        '''
+        :return: the legal value most like val, for error messages, or None if none is close. Cached per value.
+        '''
+        try:
+            return self._closest[val]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable
+            return None
+        if len(self._closest) >= self.max_suggestions:
+            self._closest.clear()
+        match = self._closest[val] = self._find_closest(val)
+        return match
+
+    def _find_closest(self, val):
+        if not isinstance(val, str):
+            return None
+        match = self.folded_values().get(val.casefold())
+        if match is None:
+            matches = difflib.get_close_matches(val, sorted(self.legal_values), n=1)
+            match = matches[0] if matches else None
+        return match
+
     def check_type(self, val):
         if not super().check_type(val):
             raise self.TypeException(self, val)
-        if val not in self.legal_values:
+        if not self.is_legal(val):
             raise self.EnumException(self, val)
         return True
 
+    def _compiled_type_check(self):
+        base = super()._compiled_type_check()
+        spec, legal_values = self, self.legal_values
+        folded = self.folded_values() if self.case_insensitive else None
+        type_exception, enum_exception = self.TypeException, self.EnumException
+
+        def check_type(val):
+            if not base(val):
+                raise type_exception(spec, val)
+            if val not in legal_values and not (folded and val.casefold() in folded):
+                raise enum_exception(spec, val)
+            return True
+
+        return check_type
+
+
+@lru_cache(maxsize=None)
+def timezone_names():
+    '''
+    :return: tuple of all timezone names, from pytz if available otherwise zoneinfo. Loaded on first use.
+    '''
+    try:
+        import pytz
+        return tuple(pytz.all_timezones)
+    except ImportError:
+        import zoneinfo
+        return tuple(sorted(zoneinfo.available_timezones()))
+
 
 class Timezone(EnumString):
     def __init__(self, name, description, **kwargs):
-        super().__init__(name, description, legal_values=pytz.all_timezones, **kwargs)
+        super().__init__(name, description, legal_values=timezone_names, **kwargs)
 
 
 class Int(ParamSpec):
@@ -362,7 +612,8 @@ class Dict(ParamSpec):
         '''
         exists_at_all = super().exists(val)
         if self.subSchema:
-            return reduce(lambda a, b: a and b.exists(val.get(b.name)), self.subSchema.required(), exists_at_all)
+            return reduce(lambda a, b: a and b.exists(val.get(b.name)), self.subSchema.required().values(),
+                          exists_at_all)
         return exists_at_all
 
     def check_basic_validity(self, val):
@@ -417,8 +668,9 @@ class NamedDict(ParamSpec):
         '''
         exists_at_all = super().exists(val)
         referenced = self.get_ref()
-        if referneced.subSchema:
-            return reduce(lambda a, b: a and b.exists(val.get(b.name)), referenced.subSchema.required(), exists_at_all)
+        if referenced.subSchema:
+            return reduce(lambda a, b: a and b.exists(val.get(b.name)), referenced.subSchema.required().values(),
+                          exists_at_all)
         return exists_at_all
 
 
@@ -458,6 +710,24 @@ class List(ParamSpec):
             raise self.TypeException(self, val)
         return ok
 
+    def _compiled_exists(self):
+        return super()._compiled_exists() if self.empty_allowed else bool
+
+    def _compiled_type_check(self):
+        base = super()._compiled_type_check()
+        spec, type_exception = self, self.TypeException
+        element_check = self.element_spec._compiled('check_type', '_compiled_type_check') if self.element_spec else None
+
+        def check_type(val):
+            ok = base(val)
+            if element_check:
+                ok = ok and all([element_check(x) for x in val])
+            if not ok:
+                raise type_exception(spec, val)
+            return ok
+
+        return check_type
+
 
 class Schema:
     '''
@@ -475,6 +745,42 @@ class Schema:
         '''
         self._specs = list(field_specs)
         self._field_map = {f.name: f for f in self._specs}
+        self._compiled = {}
+        self._categories = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_compiled'] = {}  # compiled closures and category views are rebuilt on demand
+        state['_categories'] = None
+        return state
+
+    def _category(self, name):
+        '''
+        The field category maps (read-only) and fill plan are built in one pass over the fields the first
+        time any is needed and kept until ensure_defaults changes the fields.
+        '''
+        if self._categories is None:
+            categories = dict(required={}, special_fills={}, unique={}, optional_fields={},
+                              optional_with_defaults={}, derived={})
+            for k, v in self._field_map.items():
+                categories['optional_fields' if v.optional else 'required'][k] = v
+                if v.optional and v.has_default:
+                    categories['optional_with_defaults'][k] = v
+                if v.special_fill_fn:
+                    categories['special_fills'][k] = v
+                if getattr(v, 'unique', False):
+                    categories['unique'][k] = v
+                if isinstance(v, Derived):
+                    categories['derived'][k] = v
+            categories = {k: MappingProxyType(v) for k, v in categories.items()}
+            # prepare_insert steps in the order the separate auto fills are done
+            categories['fill_plan'] = (
+                    [('required', k, v) for k, v in categories['required'].items()] +
+                    [('optional', k, v) for k, v in categories['optional_with_defaults'].items()] +
+                    [('derived', k, v) for k, v in categories['derived'].items()] +
+                    [('special', k, v) for k, v in categories['special_fills'].items()])
+            self._categories = categories
+        return self._categories[name]
 
     def required(self, additional_filter=None):
         '''
@@ -484,13 +790,13 @@ class Schema:
          be included in the returned mapping.  Typically used to weed out derived but mandatory fields.
         :return: the mapping of required fields
         '''
-        req = {k: v for k, v in self._field_map.items() if not v.optional}
+        req = self._category('required')
         if additional_filter:
             req = {k: v for k, v in req.items() if additional_filter(v)}
         return req
 
     def special_fills(self):
-        return {k: v for k, v in self._field_map.items() if v.special_fill_fn}
+        return self._category('special_fills')
 
     def get_field(self, name):
         return self._field_map.get(name)
@@ -508,7 +814,7 @@ class Schema:
         return ok and has_fields(derivable)
 
     def unique(self):
-        return {k: v for k, v in self._field_map.items() if getattr(v, 'unique', False)}
+        return self._category('unique')
 
     def do_special_fills(self, data, is_insert=True):
         '''
@@ -517,22 +823,21 @@ class Schema:
         :param data: the data to examine and possibly modify for such cases
         :return:
         '''
-        special_fills = {k: v for k, v in self._field_map.items() if (k in data and v.special_fill_fn)}
-        for k, spec in special_fills:
-            data[k] = spec.special_fill_fn(data[k])
+        for k, spec in self.special_fills().items():
+            if k in data:
+                data[k] = spec.special_fill_fn(data[k])
 
     def optional_fields(self):
-        return {k: v for k, v in self._field_map.items() if v.optional}
+        return self._category('optional_fields')
 
     def optional_with_defaults(self):
-        return {k: v for k, v in self.optional_fields().items() if v.has_default}
+        return self._category('optional_with_defaults')
 
     def derived(self):
-        return {k: v for k, v in self._field_map.items() if isinstance(v, Derived)}
+        return self._category('derived')
 
     def auto_fill_optional(self, data):
-        opt_w_default = {k: v.default for k, v in self._field_map.items() if v.optional and (v.has_default)}
-        return {k: v() for k, v in opt_w_default.items() if k not in data}
+        return {k: v.default() for k, v in self.optional_with_defaults().items() if k not in data}
 
     def auto_fill_derived(self, data, update_target=None):
         # treated derived fields as special in that we always want to include if prerequites fulfillemd
@@ -546,6 +851,35 @@ class Schema:
             if val is not None:
                 data[k] = val
 
+    def prepare_insert(self, key, data):
+        '''
+        Same as auto_fill_required, adding auto_fill_optional results, auto_fill_derived and do_special_fills
+        in turn but as a single pass over a precomputed plan of just the fields involved.
+        :param key: keys of the table or data structure as a dict. These we never autofill
+        :param data: the insert data, updated in place
+        :return: data
+        '''
+        derive_from = None
+        for step, k, spec in self._category('fill_plan'):
+            if step == 'special':
+                if k in data:
+                    data[k] = spec.special_fill_fn(data[k])
+            elif k in data:
+                continue
+            elif step == 'optional':
+                data[k] = spec.default()
+            elif step == 'derived':
+                if derive_from is None:  # as in auto_fill_derived derived values don't feed each other
+                    derive_from = dict(data)
+                val = spec.create_value(derive_from)
+                if val is not None:
+                    data[k] = val
+            elif k not in key:
+                default = spec.default()
+                if default is not None:
+                    data[k] = default
+        return data
+
     def auto_fill_required(self, key, data):
         '''
         Auto fill any required fields missing from data that we have default information for.
@@ -610,6 +944,103 @@ class Schema:
                 spec.check_basic_validity(data.get(spec.name))
         return True
 
+    def compile(self, for_update=False):
+        '''
+        Returns a function specialised for this schema that validates data exactly as validate_insert does,
+        or as validate_update_data does if for_update, raising the same exceptions.  Required fields are
+        checked with a precomputed frozenset and each field's checks are compiled closures (see
+        ParamSpec.compiled_check).  The function is cached until ensure_defaults changes the schema.
+        '''
+        compiled = self._compiled.get(for_update)
+        if compiled is not None:
+            return compiled
+        checks = self._field_checks()
+        required_order = [] if for_update else list(self.required())
+        required = frozenset(required_order)
+
+        def validate(data):
+            if required and not required.issubset(data):
+                raise MissingRequiredException([r for r in required_order if r not in data])
+            for key, val in data.items():
+                check = checks.get(key)
+                if check is not None:
+                    check(val)
+            return True
+
+        self._compiled[for_update] = validate
+        return validate
+
+    def _field_checks(self):
+        checks = self._compiled.get('checks')
+        if checks is None:
+            checks = self._compiled['checks'] = {k: spec.compiled_check() for k, spec in self._field_map.items()}
+        return checks
+
+    def validate_batch(self, records, processes=None, chunk_size=10000):
+        '''
+        Like validate_item for many records at once.  Checks go field by field down the whole batch using
+        the compiled field checks, and each distinct hashable value of a field is only checked once.
+        :param records: sequence of dict records
+        :param processes: number of worker processes to split large batches among in chunks of chunk_size.
+          Workers are forked so the schema itself need not be picklable, but records must be.
+        :param chunk_size: records per worker process task
+        :return: dict of index in records to the list of exceptions for that record, only for invalid records.
+          A MissingRequiredException comes first followed by field exceptions in schema field order.
+        '''
+        if not (processes and len(records) > chunk_size):
+            return self._validate_chunk(records)
+        report = {}
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_set_batch_schema, initargs=(self,)) as pool:
+            futures = [pool.submit(_validate_batch_chunk, records[i:i + chunk_size], i)
+                       for i in range(0, len(records), chunk_size)]
+            for future in futures:
+                report.update(future.result())
+        return report
+
+    def _validate_chunk(self, records, offset=0):
+        report = {}
+        required_order = list(self.required())
+        required = frozenset(required_order)
+        if required:
+            for i, record in enumerate(records):
+                if not required.issubset(record):
+                    missing = [r for r in required_order if r not in record]
+                    report[offset + i] = [MissingRequiredException(missing)]
+        for field, check in self._field_checks().items():
+            seen = {}
+            for i, record in enumerate(records):
+                if field not in record:
+                    continue
+                val = record[field]
+                key = (val.__class__, val)  # so 1, 1.0 and True are checked separately
+                try:
+                    error = seen[key]
+                except KeyError:
+                    error = seen[key] = _check_error(check, val)
+                except TypeError:  # unhashable
+                    error = _check_error(check, val)
+                if error is not None:
+                    report.setdefault(offset + i, []).append(error)
+        return dict(sorted(report.items()))
+
+    def validation_stats(self):
+        '''
+        :return: dict of field name to validation_stats of fields with memoized validation_fns
+        '''
+        stats = {k: getattr(v, 'validation_stats', lambda: None)() for k, v in self._field_map.items()}
+        return {k: v for k, v in stats.items() if v is not None}
+
+    def validate_recursive(self, data, fill=True):
+        '''
+        validate_insert for documents with Dict, NamedDict or List of those fields nested to any depth.
+        See RecursiveValidator.
+        '''
+        validator = self._compiled.get('recursive')
+        if validator is None:
+            validator = self._compiled['recursive'] = RecursiveValidator(self)
+        return validator.validate(data, fill=fill)
+
     def check_unique(self, item, data_unique):
         for k, v in data_unique.items():
             if item.get(k) == v:
@@ -618,14 +1049,30 @@ class Schema:
     def ensure_defaults(self, a_schema):
         self._field_map.update(a_schema._field_map)
         self._specs = [v for v in self._field_map.values()]
+        self._compiled = {}
+        self._categories = None
 
     def unique_in_items(self, data_unique, items, key=None, check_key=False):
+        '''
+        Raises UniquenessException if any of items has one of the data_unique values.
+        :param key: key of the item the data is for, as a dict
+        :param check_key: if true items with that key (the item itself when updating) are skipped
+        For repeated checks against many items use a UniquenessIndex instead.
+        '''
         key = key or {}
         check_key = check_key and key
-        same_key = lambda item: all([item[k] == key[k] for k in key.keys()])
+        same_key = lambda item: all([item.get(k) == v for k, v in key.items()])
         for item in items:
+            if check_key and same_key(item):
+                continue
             self.check_unique(item, data_unique)
 
+    def uniqueness_index(self, items=(), key_fields=('id',)):
+        '''
+        :return: UniquenessIndex of the unique fields of this schema over items
+        '''
+        return UniquenessIndex(self.unique(), key_fields, items)
+
     def validate_update_data(self, data):
         '''
         Validates the value for each key in data by its corresponding PramaSpec, if any.
@@ -640,6 +1087,229 @@ class Schema:
         return True
 
 
+class RecursiveValidator:
+    '''
+    Validates documents against a schema whose Dict and NamedDict fields (directly or as List elements) have
+    schemas of their own, possibly recursively through NamedDict references.  The references are resolved
+    once into a graph of per-schema field checks.  The document is walked without recursion and each object
+    is validated once per schema it is reached with, so shared subobjects are not revalidated and cycles in
+    the data end.  Nested levels are filled and checked as Dict.check_basic_validity does.
+    Changes to nested schemas after the validator is made are not seen.
+    '''
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._nodes = {}
+        pending = [schema]
+        while pending:
+            a_schema = pending.pop()
+            if id(a_schema) in self._nodes:
+                continue
+            node = self._nodes[id(a_schema)] = self._node(a_schema)
+            pending.extend(sub for _, _, sub in node[2].values() if sub is not None)
+
+    @staticmethod
+    def _nested_schema(spec):
+        if isinstance(spec, NamedDict):
+            return spec.get_ref().subSchema
+        if isinstance(spec, Dict):
+            return spec.subSchema
+        if isinstance(spec, List) and spec.element_spec is not None:
+            return RecursiveValidator._nested_schema(spec.element_spec)
+
+    def _node(self, schema):
+        '''
+        :return: (schema, required field names, field name to (spec, check, nested schema))
+        '''
+        fields = {}
+        checks = schema._field_checks()
+        for k, spec in schema._field_map.items():
+            nested = self._nested_schema(spec)
+            check = checks[k] if (nested is None or isinstance(spec, List)) else None
+            fields[k] = (spec, check, nested)
+        return schema, list(schema.required()), fields
+
+    def validate(self, data, fill=True):
+        '''
+        :param data: the document
+        :param fill: whether to auto fill nested levels as Dict.check_basic_validity does. The top level is
+          never filled, as for validate_insert.
+        :return: True if valid otherwise raises as validate_insert would for the first problem found
+        '''
+        done = set()
+        stack = [(data, self._nodes[id(self.schema)], False)]
+        while stack:
+            obj, node, nested = stack.pop()
+            visit = (id(obj), id(node))
+            if visit in done:
+                continue
+            done.add(visit)
+            schema, required, fields = node
+            if nested and fill:
+                schema.auto_fill_required({}, obj)
+                obj.update(schema.auto_fill_optional(obj))
+                schema.do_special_fills(obj)
+            missing = [r for r in required if r not in obj]
+            if missing:
+                raise MissingRequiredException(missing)
+            for k, val in obj.items():
+                field = fields.get(k)
+                if field is None:
+                    continue
+                spec, check, sub = field
+                if check is not None:
+                    check(val)
+                elif spec.none_check(val):
+                    continue
+                elif val is None:
+                    raise spec.RequiredException(spec)
+                elif not isinstance(val, dict):
+                    raise spec.TypeException(spec, val)
+                if sub is None or val is None:
+                    continue
+                sub_node = self._nodes[id(sub)]
+                if isinstance(spec, List):
+                    stack.extend((x, sub_node, True) for x in reversed(val) if isinstance(x, dict))
+                else:
+                    stack.append((val, sub_node, True))
+        return True
+
+
+class UniquenessIndex:
+    '''
+    Index of the values of unique fields over existing items, giving constant time uniqueness checks
+    instead of comparing against every item as Schema.unique_in_items does.  Each value maps to a Counter
+    of the keys of the items having it so the index can be kept current as items are added, removed or
+    changed.  An item whose key fields are all missing is its own owner, distinct from every other item;
+    such items are recognised by identity so remove them using the same dict that was added.
+    '''
+
+    def __init__(self, fields, key_fields=('id',), items=()):
+        '''
+        :param fields: names of the unique fields, e.g. Schema.unique()
+        :param key_fields: names of the fields making up an item's key
+        :param items: iterable of existing items, may be a stream
+        '''
+        self.fields = tuple(fields)
+        self.key_fields = tuple(key_fields)
+        self._values = {f: {} for f in self.fields}
+        self._keyless = {}
+        self.add_all(items)
+
+    def _key(self, data):
+        '''the key of data (a dict, or a key already) or None if it has no key'''
+        key = tuple(data.get(k) for k in self.key_fields) if isinstance(data, dict) else data
+        return None if all(k is None for k in key) else key
+
+    def _owner(self, item, adding=False):
+        key = self._key(item)
+        if key is not None:
+            return key
+        if adding:
+            self._keyless[id(item)] = item  # keeps the id from being reused while indexed
+        return ('keyless', id(item))
+
+    def add(self, item):
+        owner = self._owner(item, adding=True)
+        for field, values in self._values.items():
+            if item.get(field) is not None:
+                values.setdefault(item[field], Counter())[owner] += 1
+
+    def add_all(self, items):
+        for item in items:
+            self.add(item)
+
+    def remove(self, item):
+        owner = self._owner(item)
+        for field, values in self._values.items():
+            owners = values.get(item.get(field))
+            if owners and owners[owner]:
+                owners[owner] -= 1
+                if not +owners:
+                    del values[item[field]]
+        if owner[0] == 'keyless':
+            self._keyless.pop(id(item), None)
+
+    def change(self, old_item, new_item):
+        self.remove(old_item)
+        self.add(new_item)
+
+    def rebuild(self, items):
+        '''
+        Replaces the contents of the index with the values of items, an iterable that may be a stream.
+        '''
+        self._values = {f: {} for f in self.fields}
+        self._keyless = {}
+        self.add_all(items)
+
+    def owners(self, field, value):
+        '''
+        :return: set of keys of the items with value for field
+        '''
+        return set(+self._values[field].get(value, Counter()))
+
+    def _conflict(self, field, value, owner):
+        '''whether value is held by an item other than owner. An owner of None matches no item.'''
+        owners = self._values[field].get(value)
+        return bool(owners) and any(n and (o != owner) for o, n in owners.items())
+
+    def check(self, data, key=None):
+        '''
+        Raises UniquenessException if a unique value in data is held by an item other than the one with key.
+        :param key: key of the item data is for, as a dict or tuple, if any.  Defaults to the key in data.
+          Data without a key is a new item, conflicting with any holder of its values.
+        :return: True
+        '''
+        owner = self._key(data) if key is None else self._key(key)
+        for field in self.fields:
+            value = data.get(field)
+            if (value is not None) and self._conflict(field, value, owner):
+                raise UniquenessException(field, value)
+        return True
+
+    def check_batch(self, records):
+        '''
+        Checks a batch of records to be written against the index and against each other.
+        :return: dict of index in records to list of UniquenessExceptions, only for records with conflicts.
+          Of records within the batch sharing a value all but the first are reported.  Records without a key
+          (e.g. new items before their id is filled) are each treated as a distinct item.
+        '''
+        report = {}
+        owners = []
+        for i, record in enumerate(records):
+            owner = self._key(record)
+            owners.append(('batch record', i) if owner is None else owner)
+        for field in self.fields:
+            first_owner = {}
+            for i, record in enumerate(records):
+                value = record.get(field)
+                if value is None:
+                    continue
+                owner = owners[i]
+                if (first_owner.setdefault(value, owner) != owner) or self._conflict(field, value, owner):
+                    report.setdefault(i, []).append(UniquenessException(field, value))
+        return dict(sorted(report.items()))
+
+
+_batch_schema = None
+
+
+def _set_batch_schema(schema):
+    global _batch_schema
+    _batch_schema = schema
+
+
+def _validate_batch_chunk(records, offset):
+    return _batch_schema._validate_chunk(records, offset)
+
+
+def _check_error(check, val):
+    try:
+        check(val)
+    except Exception as e:
+        return e
+
+
 class StandardDBSchema(Schema):
     defaults = Schema(
         ID('id', 'generated unique id', optional=False, default_fn=utils.generate_unique_id),
@@ -2,40 +2,53 @@ from om_int_common.web.utils import json_or_error, split_special
 import httpx, asyncio
 from functools import wraps, partial
 from httpx import ConnectError
+from sjautils.retry import RetryPolicy
+
+connection_policy = RetryPolicy(base=0.5, cap=5.0, max_attempts=2)
+throttle_policy = RetryPolicy(base=1.0, cap=60.0, max_elapsed=600.0)
+
+
+def connection_retry(fn, policy=None):
+    policy = policy or connection_policy
 
-def connection_retry(fn):
     @wraps(fn)
     async def inner(*args, **kwargs):
-        reset_count = [0]
         path = '/'.join([str(a) for a in args[1:]])
-
-        def note_reset():
-            reset_count[0] += 1
-            print(f'got reset #{reset_count[0]} for {path}')
-            return reset_count[0]
-
+        state = policy.begin()
         while True:
             try:
-                return await fn(*args, **kwargs)
-            except ConnectError as _:
-                if note_reset() < 3:
-                    continue
-                raise Exception(f'more than 3 consecutive connection errors on {path}')
+                res = await fn(*args, **kwargs)
+                state.succeeded()
+                return res
+            except ConnectError as e:
+                resets = state.attempt + 1
+                print(f'got reset #{resets} for {path}')
+                wait = state.next_wait(e)
+                if wait is None:
+                    raise Exception(f'{resets} consecutive connection errors on {path}')
+                await asyncio.sleep(wait)
     return inner
 
 
-def throttle_retry(fn):
-    throttle_wait = 5
+def throttle_retry(fn, policy=None):
+    policy = policy or throttle_policy
+
     @wraps(fn)
     async def inner(*args, **kwargs):
         throttle_time = 0
         path = '/'.join([str(a) for a in args[1:]])
+        state = policy.begin()
         res = await fn(*args, **kwargs)
         while (res is not None) and (res.status_code == 429):
-            print(f'throttling {fn.__name__} {path}; throttle:{throttle_wait}, previous: {throttle_time}')
+            throttle_wait = state.next_wait(res)
+            if throttle_wait is None:
+                break
+            print(f'throttling {fn.__name__} {path}; throttle:{throttle_wait:.2f}, previous: {throttle_time:.2f}')
             await asyncio.sleep(throttle_wait)
             throttle_time += throttle_wait
             res = await fn(*args, **kwargs)
+        else:
+            state.succeeded()
         return res
     return inner
 